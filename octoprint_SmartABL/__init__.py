@@ -1,64 +1,147 @@
 # coding=utf-8
 from __future__ import absolute_import
 
+import hashlib
 import json
 import logging
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
+from typing import FrozenSet, NamedTuple, Tuple
 
+import flask
+import numpy as np
+import octoprint.filemanager
+import octoprint.filemanager.util
 import octoprint.plugin
 
+from .firmware import FirmwareRegistry, firmware_uuid, parse_cap
+from .heatmap import HeatmapCache
+from .history import DecisionHistory
+from .library import MeshLibrary
+from .logs import Lazy, RingBufferHandler, queue_logging
+from .machine import (
+    DECIDING,
+    IDLE,
+    PREFETCHING,
+    PROBING,
+    QUERYING,
+    SAVING,
+    StateMachine,
+)
+from .mesh import MeshHistory, MeshParser, drift, quality
+from .metrics import Metrics
+from .predict import fit, reference, usage_features
+from .preprocess import MarkerStream
+from .prescan import PrescanIndex, header, scan
+from .scheduler import Scheduler
+from .storage import BackgroundWriter, atomic_write, load_json
+from .temperature import TEMP_GCODES, TempTarget, parse_temp, parse_tool
+
+
+class GcodeMatcher(NamedTuple):
+    trigger: FrozenSet[str] = frozenset()
+    ignore: FrozenSet[str] = frozenset()
+    custom: Tuple[str, ...] = ()
+    cmd_ignore: bool = False
+    abl_custom: bool = False
+
 
 class SmartABLPlugin(
     octoprint.plugin.AssetPlugin,
     octoprint.plugin.EventHandlerPlugin,
     octoprint.plugin.SettingsPlugin,
+    octoprint.plugin.ShutdownPlugin,
     octoprint.plugin.SimpleApiPlugin,
     octoprint.plugin.TemplatePlugin,
 ):
-    fw_metadata = {
-        "marlin": {
-            "abl": "G29",
-            "load": "M420 S1",
-            "info": (
-                "M420 V1",
-                ["Invalid mesh"],
-                ["Bilinear Leveling Grid", "Bed Topography Report"],
-            ),
-            "save": "M500",
-        },
-        "prusa": {
-            "abl": "G80",
-            "info": (
-                "G81",
-                ["Mesh bed leveling not active"],
-                ["Measured points"],
-            ),
-        },
-        "klipper": {
-            "abl": "BED_MESH_CALIBRATE",
-            "info": (
-                "BED_MESH_OUTPUT",
-                ["Bed has not been probed"],
-                ["Mesh Leveling Probed Z positions"],
-            ),
-        },
-    }
     temp = {"he": "M109", "bed": "M190"}
+    log_levels = ("DEBUG", "INFO", "WARNING")
+    # mesh query timeout: p99 of the firmware round trips times factor
+    query_timeout = dict(
+        floor=2.0, ceiling=15.0, factor=3.0, samples=50, misses=3
+    )
+    # frontend updates within this window are sent as a single message
+    push_delay = 0.25
+    # a bed wait still deferred is sent before the first move
+    moves = frozenset(("G0", "G1", "G2", "G3"))
+    # not marked in preprocessed files
+    rechecked = frozenset(("G28", "M190"))
+    # numeric settings left empty to skip their check, the rest get the
+    # default value back
+    optional = frozenset(
+        (
+            "quality_range",
+            "quality_residual",
+            "quality_outlier",
+            "quality_missing",
+        )
+    )
 
     def __init__(self):
-        self.smart_logger = None
+        self._smartabl_logger = None
+        self.log_listener = None
+        self.log_buffer = RingBufferHandler()
+        self.writer = None
         self.state = None
         self.valid_mesh = False
-        self.cache = set()
+        self.machine = StateMachine()
+        self.held = False
+        self.queried = False
+        self.prefetched = None
+        self.temps_seen = set()
+        self.heat_wait = None
         self.force_temp = False
         self.firmware = None
         self.probe_required = False
         self.save_allowed = True
+        self.persist_pending = False
+        self.reloaded = False
         self.last_cmd = None
-        self.querying = False
-        self.thread = None
-        self.event = None
+        self.scheduler = None
+        self.query_timer = None
+        self.query_sent = None
+        # the query timed out, its report may still arrive
+        self.query_late = False
+        self.metrics = Metrics()
+        self.hold_start = None
+        self.abl_sent = None
+        self.drift_sent = None
+        self.prescan = None
+        self.prescanner = None
+        self.job_index = None
+        self.job_key = None
+        self.job_marked = False
+        self.tool = 0
+        self.job_temps = {}
+        self.matcher = GcodeMatcher()
+        self.mesh_parser = None
+        self.meshes = None
+        self.heatmaps = HeatmapCache()
+        self.probes = []
+        self.mesh_slots = False
+        self.library = None
+        self.library_key = None
+        self.profiles = None
+        self.profile = None
+        self.port = None
+        self.banner = None
+        self.capabilities = {}
+        self.detecting = False
+        self.history = None
+        self.job_file = None
+        self.last_decision = None
+        self.status_lock = threading.Lock()
+        self.status_cache = (None, None, None)
+        self.status_pushed = {}
+        self.status_timer = None
+        self.job_start = None
+        self.drift_model = None
+        self.drift_model_key = None
+        self.mesh_report = None
+        self.region = None
+        self.mesh_issues = []
 
     # Plugin: Parent class
     def initialize(self):
@@ -70,19 +153,22 @@ class SmartABLPlugin(
                 f"%(asctime)s ({self._plugin_version}): %(message)s"
             )
         )
-        console_logging_handler.setLevel(logging.DEBUG)
         self._smartabl_logger = logging.getLogger(
             f"octoprint.plugins.{self._identifier}"
         )
-        self._smartabl_logger.addHandler(console_logging_handler)
-        # some users don't enable it, so it's better to enable it by default...
-        self._smartabl_logger.setLevel(logging.DEBUG)
+        # file writes happen in the listener thread, not in the comm thread
+        self.log_listener = queue_logging(
+            self._smartabl_logger, console_logging_handler, self.log_buffer
+        )
+        self._set_log_level()
         self._smartabl_logger.propagate = False
 
-        try:
-            with open(f"{self.get_plugin_data_folder()}/state.json") as f:
-                self.state = json.load(f)
-        except FileNotFoundError:
+        self.writer = BackgroundWriter(logger=self._smartabl_logger)
+        self.writer.start()
+        self.scheduler = Scheduler(logger=self._smartabl_logger)
+        self.scheduler.start()
+        self.state = load_json(self._state_path(), self._smartabl_logger)
+        if self.state is None:
             self.state = dict(
                 first_time=True, prints=0, last_mesh=self._today()
             )
@@ -92,8 +178,65 @@ class SmartABLPlugin(
             self.state["last_bedtemp"] = 0
         if "last_hetemp" not in self.state:
             self.state["last_hetemp"] = 0
+        if "last_temps" not in self.state:
+            self.state["last_temps"] = dict(
+                bed=self.state["last_bedtemp"],
+                tool0=self.state["last_hetemp"],
+            )
+        if "mesh_temps" not in self.state:
+            self.state["mesh_temps"] = dict(self.state["last_temps"])
+        if "library" not in self.state:
+            self.state["library"] = {}
+        if "rtt" not in self.state:
+            self.state["rtt"] = {}
+        if "misses" not in self.state:
+            self.state["misses"] = {}
+        if "firmwares" not in self.state:
+            self.state["firmwares"] = {}
+        if "persisted" not in self.state:
+            self.state["persisted"] = {}
+        if "partial_mesh" not in self.state:
+            self.state["partial_mesh"] = None
+        if "usage" not in self.state:
+            self.state["usage"] = dict(prints=0, hours=0.0, cycles=0)
+        self.library = MeshLibrary(
+            self.state["library"], self._get("library_slots", "i")
+        )
         self._save()
-        self._smartabl_logger.debug(f"@initialize > {self._dbg()}")
+        self.meshes = MeshHistory(
+            f"{self.get_plugin_data_folder()}/meshes.npz"
+        )
+        try:
+            self.meshes.load()
+        except Exception:
+            self._smartabl_logger.exception(
+                "@initialize > Error loading mesh history"
+            )
+        try:
+            self.history = DecisionHistory(
+                f"{self.get_plugin_data_folder()}/history.db",
+                logger=self._smartabl_logger,
+            )
+            self.history.start()
+        except Exception:
+            self.history = None
+            self._smartabl_logger.exception(
+                "@initialize > Error opening decision history"
+            )
+        self.profiles = FirmwareRegistry(
+            f"{self.get_plugin_data_folder()}/firmwares",
+            logger=self._smartabl_logger,
+        ).load()
+        self.prescan = PrescanIndex(
+            f"{self.get_plugin_data_folder()}/prescan.json",
+            logger=self._smartabl_logger,
+        )
+        self.prescan.load()
+        self.prescanner = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="SmartABL prescan"
+        )
+        self._build_matcher()
+        self._log("initialize", " > %s", self._dbg())
 
     # AssetPlugin
     def get_assets(self):
@@ -116,22 +259,114 @@ class SmartABLPlugin(
             bedtemp=False,
             hetemp=False,
             force_unknown=False,
+            # some users don't enable it, so it's better to enable it
+            # by default...
+            log_level="DEBUG",
+            drift_check=False,
+            drift_points="",
+            drift_threshold=0.05,
+            mesh_bounds="",
+            library=False,
+            temp_band=5,
+            sheet="",
+            library_slots=4,
+            temp_tolerance=5,
+            predict=False,
+            adaptive=False,
+            adaptive_margin=10,
+            early_query=False,
+            early_query_age=600,
+            quality_check=False,
+            quality_range=2.0,
+            quality_residual=1.0,
+            quality_outlier=0.3,
+            quality_missing=0,
+            save_config=False,
+            heat_probe=False,
+            heat_fraction=0.9,
+            preprocess=False,
         )
 
+    def on_settings_save(self, data):
+        octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        self._build_matcher()
+        self._set_log_level()
+        self.library.slots = self._get("library_slots", "i")
+        self._update_frontend()
+
+    # ShutdownPlugin
+    def on_shutdown(self):
+        if self.prescanner is not None:
+            self.prescanner.shutdown(wait=False)
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        if self.history is not None:
+            self.history.stop()
+        if self.writer is not None:
+            self.writer.stop()
+        if self.log_listener is not None:
+            self.log_listener.stop()
+            self.log_listener = None
+
     # SimpleApiPlugin
     def get_api_commands(self):
-        return dict(abl_always=["value"])
+        return dict(abl_always=["value"], debug_dump=[])
+
+    def on_api_get(self, request):
+        if "metrics" in request.args:
+            if request.args.get("metrics") == "prometheus":
+                return flask.Response(
+                    self.metrics.prometheus(self._gauges()),
+                    mimetype="text/plain; version=0.0.4",
+                )
+            return flask.jsonify(
+                metrics=self.metrics.snapshot(), gauges=self._gauges()
+            )
+        if not request.args:
+            body, etag = self._status_body()
+            response = flask.Response(body, mimetype="application/json")
+            response.set_etag(etag)
+            # If-None-Match with the same etag gets an empty 304
+            return response.make_conditional(request)
+        if "transitions" in request.args:
+            return flask.jsonify(self.machine.snapshot())
+        if "heatmap" in request.args:
+            return self._heatmap(request)
+        if "history" in request.args and self.history is not None:
+            try:
+                return flask.jsonify(
+                    self.history.query(
+                        limit=request.args.get("limit", 50),
+                        before=request.args.get("before"),
+                        outcome=request.args.get("outcome"),
+                        since=request.args.get("since"),
+                        until=request.args.get("until"),
+                    )
+                )
+            except ValueError:
+                pass
+        return flask.abort(400)
 
     def on_api_command(self, command, data):
-        self.state["abl_always"] = data["value"]
-        self._save()
-        self._smartabl_logger.debug(
-            f"@on_api_command:update_button > {self._dbgstate()}"
-        )
+        if command == "debug_dump":
+            return flask.jsonify(records=self.log_buffer.dump())
+        with self.machine.lock:
+            self.state["abl_always"] = data["value"]
+            self._save()
+        self._update_frontend()
+        self._log("on_api_command:update_button", " > %s", self._dbgstate())
 
     # TemplatePlugin
     def get_template_configs(self):
-        return [dict(type="settings", custom_bindings=False)]
+        return [
+            dict(type="settings", custom_bindings=False),
+            dict(
+                type="sidebar",
+                name="SmartABL mesh",
+                icon="th",
+                custom_bindings=False,
+            ),
+        ]
 
     def get_template_vars(self):
         return dict(version=self._plugin_version)
@@ -139,31 +374,111 @@ class SmartABLPlugin(
     # EventHandlerPlugin
     def on_event(self, event, payload):
         if event == "ClientOpened":
+            # new clients need the whole status, not a delta
+            with self.status_lock:
+                self.status_pushed = self._status()
             self._plugin_manager.send_plugin_message(
-                self._identifier, {"abl_always": self.state["abl_always"]}
+                self._identifier, {"status": self.status_pushed}
             )
-            self._update_frontend()
+        elif event == "Connected":
+            self.port = payload.get("port")
+            if self.firmware is None:
+                self._restore_firmware()
+            else:
+                self._cache_firmware()
+            self._prefetch(event)
         elif event == "Disconnected":
             self.firmware = None
+            self.profile = None
+            self.port = None
+            self.detecting = False
+            self.prefetched = None
+            self.persist_pending = False
+            self.reloaded = False
+            self.heat_wait = None
+            self.job_marked = False
+            self._drop_volatile(event)
+            self._reset(event)
+            self.mesh_parser = None
+            self.mesh_slots = False
+            self.mesh_report = None
+            self._update_frontend()
+        elif event in ("FileAdded", "FileSelected"):
+            path = self._local_path(payload)
+            if path is not None:
+                self.prescanner.submit(self._prescan_file, path)
+        elif event == "PrintStarted":
+            if self.machine.state != PREFETCHING:  # query sent on connect
+                self._reset(event)
+            self.job_file = payload.get("path")
+            self.job_start = time.monotonic()
+            bed = self._printer.get_current_temperatures().get("bed") or {}
+            if (bed.get("actual") or 0) < 40:  # starting from a cold bed
+                self.state["usage"]["cycles"] += 1
+            self.job_index = None
+            self.job_key = None
+            self.queried = False
+            self.reloaded = False
+            self.heat_wait = None
+            self.temps_seen = set()
+            self.force_temp = False
+            self.job_temps = {}
+            self.tool = 0
+            path = self._local_path(payload)
+            self.job_marked = False
+            if path is not None:
+                try:
+                    self.job_key = PrescanIndex.key(path, self.matcher)
+                except OSError:
+                    pass
+                else:
+                    self.job_index = self.prescan.get(self.job_key)
+                    if self.job_index is None:
+                        # selected and printed at once, still scanning
+                        self.prescanner.submit(self._prescan_file, path)
+                self.job_marked = self._marked(path)
+            self._log(
+                "on_event:print_start",
+                " > Prescan(file=%s, index=%s, marked=%s)",
+                path,
+                self.job_index,
+                self.job_marked,
+            )
+            self._check_index_temps()
+            # answered while the printer heats and homes
+            self._prefetch(event)
         if self.firmware is not None and event in (
             "PrintDone",
             "PrintFailed",
         ):
-            self._smartabl_logger.debug(
-                f"@on_event > Trigger(event={event}) || {self._dbg()}"
-            )
-            if event in self._events():
-                self.state["prints"] += 1
-            self._printer.set_job_on_hold(False)
-            if self.event is not None:
-                self.event.set()
-            self.thread = None
-            self.event = None
-            self._smartabl_logger.debug(
-                f"@on_event:print_stop > {self._dbg()}"
-            )
-            self._update_frontend()
-            self._save()
+            with self.machine.lock:
+                self._log(
+                    "on_event",
+                    " > Trigger(event=%s) || %s",
+                    event,
+                    self._dbg(),
+                )
+                usage = self.state["usage"]
+                usage["prints"] += 1
+                if self.job_start is not None:
+                    usage["hours"] += (
+                        time.monotonic() - self.job_start
+                    ) / 3600
+                    self.job_start = None
+                if event in self._events():
+                    self.state["prints"] += 1
+                    entry = self.library.get(self.library_key)
+                    if entry is not None:
+                        entry["prints"] += 1
+                self.library_key = None
+                self.job_marked = False
+                self._reset(event)
+                self.abl_sent = None
+                if self.persist_pending:
+                    self._persist_mesh()
+                self._log("on_event:print_stop", " > %s", self._dbg())
+                self._update_frontend()
+                self._save()
 
     # Hook: octoprint.comm.protocol.gcode.queuing
     def gcode_queuing(
@@ -175,208 +490,133 @@ class SmartABLPlugin(
             and kwargs["tags"] is not None
             and "source:file" in kwargs["tags"]
         ):
-            if self._get("cmd_ignore") and (
-                gcode in self._gcodes_ignore() or cmd in self._gcodes_ignore()
-            ):
-                self._smartabl_logger.debug(
-                    f"@gcode_queuing:ignore > "
-                    f"Trigger(cmd={cmd}, gcode={gcode}) || "
-                    f"{self._dbg()}"
-                )
-                return [None]
-            elif gcode == "G28":
-                self.cache = set()
-            elif (
-                gcode in self._gcodes_abl() or cmd in self._gcodes_abl()
-            ) and "SMARTABLQUERY" not in self.cache:
-                self.cache.add("SMARTABLQUERY")
-                self._smartabl_logger.debug(
-                    f"@gcode_queuing:abl > "
-                    f"Trigger(cmd={cmd}, gcode={gcode}) || "
-                    f"{self._dbg()}"
+            if self.job_marked:
+                # preprocessed: triggers and ignored come as @SMARTABLMARK
+                if gcode in self.rechecked or (
+                    self.heat_wait is not None and gcode in self.moves
+                ):
+                    return self._file_line(cmd, gcode)
+                return [cmd]
+            return self._file_line(cmd, gcode)
+        return [cmd]
+
+    def _file_line(self, cmd, gcode):
+        matcher = self.matcher
+        if matcher.cmd_ignore and (
+            gcode in matcher.ignore or cmd in matcher.ignore
+        ):
+            self._log(
+                "gcode_queuing:ignore",
+                " > Trigger(cmd=%s, gcode=%s) || %s",
+                cmd,
+                gcode,
+                self._dbg(),
+            )
+            return [None]
+        elif gcode == "G28":
+            self.queried = False
+            self.temps_seen = set()
+        elif (
+            gcode in matcher.trigger or cmd in matcher.trigger
+        ) and not self.queried:
+            # temperatures of a scan that ended after the print started
+            self._job_index()
+            with self.machine.lock:
+                if self.machine.state == IDLE and self._prefetch_fresh():
+                    return self._decide_early(cmd, gcode)
+                if not self._transition(QUERYING, cmd):
+                    return [cmd]
+                self.queried = True
+                self._log(
+                    "gcode_queuing:abl",
+                    " > Trigger(cmd=%s, gcode=%s) || %s",
+                    cmd,
+                    gcode,
+                    self._dbg(),
                 )
-                self._printer.set_job_on_hold(True)
-                if self.thread is None:
-                    self.thread = threading.Thread(
-                        target=self._unlock_queue, daemon=True
-                    )
-                    self.event = threading.Event()
-                    self.thread.start()
+                self._arm_query_timer()
                 self.last_cmd = cmd
-                cmd = ["@SMARTABLQUERY"]
-                self._smartabl_logger.debug(
-                    f"@gcode_queuing:abl_send >> Sending {cmd}"
-                )
-                return cmd
+            cmd = ["@SMARTABLQUERY"]
+            self._log("gcode_queuing:abl_send", " >> Sending %s", cmd)
+            return cmd
+        elif gcode == "M190" and not self.queried:
+            return self._defer_heat(cmd)
+        elif self.heat_wait is not None and gcode in self.moves:
+            return self._flush_heat(cmd)
         return [cmd]
 
+    def _flush_heat(self, cmd):
+        # no trigger before the print, wait for the bed anyway
+        cmds = [self.heat_wait, cmd]
+        self.heat_wait = None
+        self._log("gcode_queuing:heat_flush", " >> Sending %s", cmds)
+        return cmds
+
     # Hook: octoprint.comm.protocol.atcommand.sending
     def at_command(
         self, comm_instance, phase, cmd, parameters, tags=None, *args, **kwargs
     ):
-        if cmd == "SMARTABLSAVE":
-            if self.state["first_time"]:
-                self.state["first_time"] = False
-            self.state["prints"] = 0
-            self.state["last_mesh"] = self._today()
-            self._save()
-            self._update_frontend()
-            if self.save_allowed:
-                cmds = self.fw_metadata[self.firmware]["save"]
-                self._smartabl_logger.debug(
-                    f"@at_command:save >> Sending {cmds} > "
-                    f"{self._dbgstate()} || "
-                    f"{self._dbginternal()}"
-                )
-                self._printer.commands(cmds)
-            else:
-                self._smartabl_logger.debug(
-                    f"@at_command:save > {self._dbgstate()} || "
-                    f"{self._dbginternal()}"
-                )
-        elif cmd == "SMARTABLQUERY":
-            self.querying = True
-            cmds = self.fw_metadata[self.firmware]["info"][0]
-            self._smartabl_logger.debug(
-                f"@at_command:query >> Mesh query(cmd={cmds}) > "
-                f"{self._dbginternal()}"
-            )
+        if cmd == "SMARTABLMARK":
+            self._marked_line(parameters)
+            return
+        # the comm, scheduler and api threads change the state
+        with self.machine.lock:
+            self._at_command(cmd)
+
+    def _marked_line(self, line):
+        # a line of a preprocessed file, checked as if it was queued
+        words = line.split(None, 1)
+        gcode = words[0].upper() if words else None
+        if self.firmware is None:
+            cmds = [line]
+        else:
+            cmds = self._file_line(line, gcode)
+        cmds = [cmd for cmd in cmds if cmd is not None]
+        self._log("at_command:marked", " > %s >> Sending %s", line, cmds)
+        for cmd in cmds:
+            if cmd.split(None, 1)[0].upper() in TEMP_GCODES:
+                # not a file line when it's sent
+                self._sent_temp(cmd)
+        if cmds:
             self._printer.commands(cmds)
-        elif cmd == "SMARTABLDECIDE" and cmd not in self.cache:
-            self.cache.add(cmd)
-            cmds = None
-            if (
-                self.state["abl_always"]
-                or self.probe_required
-                or self.force_temp
-                or self.state["first_time"]
-                or not self.valid_mesh
-                or (
-                    self._get("force_days")
-                    and self._diff_days() >= self._get("days", "i")
-                )
-                or (
-                    self._get("force_prints")
-                    and self.state["prints"] >= self._get("prints", "i")
-                )
-            ):
-                self.force_temp = False
-                if "M420" in self.last_cmd:
-                    cmds = [self.fw_metadata[self.firmware]["abl"]]
-                else:
-                    cmds = [self.last_cmd]
-                if self._get("abl_custom"):
-                    cmds = self._gcodes_custom()
-                if self.save_allowed:
-                    self.cache.add(self.fw_metadata[self.firmware]["save"])
-                cmds.append("@SMARTABLSAVE")
-                self._smartabl_logger.debug(
-                    f"@at_command:decide >> ABL trigger >> Sending {cmds} > "
-                    f"{self._dbg()}"
-                )
-                self.probe_required = False
-            else:
-                if self.save_allowed:
-                    if self.last_cmd.startswith("M420 S1 Z"):
-                        cmds = [self.last_cmd]
-                    else:
-                        cmds = [self.fw_metadata[self.firmware]["load"]]
-                self._smartabl_logger.debug(
-                    f"@at_command:decide >> ABL skip >> Sending {cmds} > "
-                    f"{self._dbg()}"
-                )
-            if cmds is not None:
-                self._printer.commands(cmds)
-            self._printer.set_job_on_hold(False)
-            self.querying = False
-            if self.event is not None:
-                self.event.set()
-            self.thread = None
-            self.event = None
-        elif cmd == "SMARTABLRESET":
-            self.state["prints"] = 0
-            self.state["last_mesh"] = self._today()
-            self._save()
-            self._update_frontend()
-            self._smartabl_logger.debug(
-                f"@at_command:reset > "
-                f"{self._dbgstate()} || "
-                f"{self._dbginternal()}"
-            )
 
     # Hook: octoprint.comm.protocol.gcode.received
     def process_line(self, comm_instance, line, *args, **kwargs):
         if self.firmware is None:
             if "FIRMWARE_NAME" in line:
-                self._smartabl_logger.debug(
-                    f"@process_line:firmware >> {line}"
-                )
-                idx = line.find("FIRMWARE_NAME")
-                for fw_n in self.fw_metadata:
-                    pattern = line[idx : idx + 40].lower()
-                    if fw_n in pattern:
-                        buddy = False
-                        if "buddy" in pattern:
-                            self.firmware = "marlin"
-                            buddy = True
-                        else:
-                            self.firmware = fw_n
-                        if self.firmware != "marlin" or buddy:
-                            self.save_allowed = False
-                            self.probe_required = True
-                        if buddy:
-                            self._smartabl_logger.debug(
-                                f"@process_line:detected_firmware >> "
-                                f"prusa-buddy > {self._dbginternal()}"
-                            )
-                        else:
-                            self._smartabl_logger.debug(
-                                f"@process_line:detected_firmware >> "
-                                f"{fw_n} > {self._dbginternal()}"
-                            )
-                        break
-                else:
-                    if self._get("force_unknown"):
-                        self.firmware = "marlin"
-                        self._smartabl_logger.debug(
-                            f"@process_line:detected_firmware >> "
-                            f"unknown* > {self._dbginternal()}"
-                        )
-                    else:
-                        self._smartabl_logger.debug(
-                            "@process_line:detected_firmware >> unknown"
-                        )
-                        self._plugin_manager.send_plugin_message(
-                            self._identifier,
-                            {
-                                "abl_notify": (
-                                    "SmartABL: disabled",
-                                    "Unknown firmware. Open an Issue "
-                                    "on GitHub indicating your "
-                                    "firmware and logs. Or force SmartABL"
-                                    "on unknown firmware, check settings "
-                                    "for more info.",
-                                )
-                            },
-                        )
+                self._detect(line)
         else:
-            if "EEPROM disabled" in line:  # marlin eeprom disabled
+            if self.detecting:
+                self._detect_line(line)
+            state = self.machine.state
+            if self.mesh_parser is not None:
+                with self.machine.lock:
+                    if self.mesh_parser is not None and self.mesh_parser.feed(
+                        line
+                    ):
+                        self._mesh_parsed()
+            elif "EEPROM disabled" in line:  # marlin eeprom disabled
                 self.save_allowed = False
-            elif self._line_mesh(line) and self.querying:
-                cmds = "@SMARTABLDECIDE"
-                self.valid_mesh = self._valid_mesh(line)
-                self._smartabl_logger.debug(
-                    f"@process_line:"
-                    f"{'' if self.valid_mesh else 'in'}valid_mesh >> "
-                    f"Sending {cmds} > {self._dbginternal()}"
-                )
-                self._printer.commands(cmds)
-            # elif "M420 S1.0 Z0.0" in line:
-            #     self.valid_mesh = True
-            #     self._smartabl_logger.debug(
-            #         f"@process_line:VIRTUALPRINTER > {self._dbginternal()}"
-            #     )
-            #     self._printer.commands("@SMARTABLDECIDE")
+            elif state == IDLE or state == DECIDING:
+                if self.query_late:
+                    # the report of a query that timed out, the next line
+                    # isn't sent before it (G29 also prints the grid)
+                    match = self.profile.mesh.regx.search(line)
+                    if match is not None:
+                        with self.machine.lock:
+                            self._mesh_matched(match.group())
+            elif state == PROBING:
+                if self.machine.drift:
+                    match = self.profile.probe.search(line)
+                    if match is not None:
+                        self.probes.append(
+                            tuple(float(match.group(ax)) for ax in "xyz")
+                        )
+            else:
+                match = self.profile.mesh.regx.search(line)
+                if match is not None:
+                    with self.machine.lock:
+                        self._mesh_matched(match.group())
         return line
 
     # Hook: octoprint.comm.protocol.gcode.sent
@@ -387,36 +627,60 @@ class SmartABLPlugin(
             self.firmware is not None
             and "tags" in kwargs
             and kwargs["tags"] is not None
-            and f"plugin:{self._identifier}" in kwargs["tags"]
             and "source:file" in kwargs["tags"]
-            and gcode in self._gcodes_temp()
         ):
-            self._smartabl_logger.debug(
-                f"@gcode_sent:temp > Trigger(cmd={cmd}) || {self._dbg()}"
-            )
-            if gcode not in self.cache:
-                self.cache.add(gcode)
-                setting = "bedtemp"
-                state = "last_bedtemp"
-                if gcode == self.temp["he"]:
-                    setting = "hetemp"
-                    state = "last_hetemp"
-                try:
-                    temp = int(self.temp_regx.match(cmd).group(1))
-                except AttributeError:
-                    self._smartabl_logger.debug(
-                        f"@gcode_sent:temp_error > Trigger(cmd={cmd}) || "
-                        f"{self._dbg()}"
-                    )
-                else:
-                    if self._get(setting) and temp != self.state[state]:
-                        self.force_temp = True
-                    self.state[state] = temp
-                    self._save()
-                    self._smartabl_logger.debug(
-                        f"@gcode_sent:{setting} > "
-                        f"{self._dbgstate()} || {self._dbginternal()}"
-                    )
+            if gcode in TEMP_GCODES:
+                self._sent_temp(cmd)
+            elif gcode == "T":
+                tool = parse_tool(cmd)
+                if tool is not None:
+                    self.tool = tool
+
+    def _sent_temp(self, cmd):
+        self._log(
+            "gcode_sent:temp",
+            " > Trigger(cmd=%s) || %s",
+            cmd,
+            self._dbg(),
+        )
+        temp = parse_temp(cmd, self.tool)
+        if temp is None:
+            self._log(
+                "gcode_sent:temp_error",
+                " > Trigger(cmd=%s) || %s",
+                cmd,
+                self._dbg(),
+            )
+        else:
+            self._check_temp(temp)
+
+    # Hook: octoprint.filemanager.preprocessor
+    def preprocess(
+        self,
+        path,
+        file_object,
+        links=None,
+        printer_profile=None,
+        allow_overwrite=True,
+        *args,
+        **kwargs,
+    ):
+        if (
+            not self._get("preprocess")
+            or not self.matcher.trigger
+            or not octoprint.filemanager.valid_file_type(path, type="gcode")
+        ):
+            return file_object
+        self._log(
+            "preprocess",
+            " > Marking(path=%s, settings=%s)",
+            path,
+            header(self.matcher),
+        )
+        return octoprint.filemanager.util.StreamWrapper(
+            file_object.filename,
+            MarkerStream(file_object.stream(), self.matcher),
+        )
 
     # Hook: octoprint.plugin.softwareupdate.check_config
     def get_update_information(self):
@@ -437,96 +701,500 @@ class SmartABLPlugin(
             }
         }
 
+    def _at_command(self, cmd):
+        if cmd == "SMARTABLSAVE" and self._transition(SAVING, cmd):
+            if self.abl_sent is not None:
+                elapsed = time.monotonic() - self.abl_sent
+                self.metrics.observe("abl_seconds", elapsed)
+                self._record("probed", duration=elapsed)
+                self.abl_sent = None
+            self._capture_mesh()
+            if self.state["first_time"]:
+                self.state["first_time"] = False
+            if self.region is None:
+                # only the whole bed tells how old the mesh is
+                self.state["prints"] = 0
+                self.state["last_mesh"] = self._today()
+            self.state["mesh_temps"].update(self.job_temps)
+            # a partial mesh never replaces the full one (eeprom, slots)
+            self.state["partial_mesh"] = self.region
+            if self.region is None:
+                self._library_store()
+            self._save()
+            self._update_frontend()
+            if self.save_allowed and self.region is None:
+                cmds = self.profile.metadata["save"]
+                self._log(
+                    "at_command:save",
+                    " >> Sending %s > %s || %s",
+                    cmds,
+                    self._dbgstate(),
+                    self._dbginternal(),
+                    level=logging.INFO,
+                )
+                self._printer.commands(cmds)
+                self.persist_pending = "persist" in self.profile.metadata
+                if self.persist_pending:
+                    # the saved mesh is newer than the persisted one
+                    self.state["persisted"][self.port] = False
+            else:
+                self._log(
+                    "at_command:save",
+                    " > %s || %s",
+                    self._dbgstate(),
+                    self._dbginternal(),
+                    level=logging.INFO,
+                )
+        elif cmd == "SMARTABLQUERY" and self.machine.state == QUERYING:
+            # restart the deadline now that the query is leaving
+            self.query_sent = time.monotonic()
+            self._arm_query_timer()
+            cmds = self.profile.metadata["info"][0]
+            self._log(
+                "at_command:query",
+                " >> Mesh query(cmd=%s) > %s",
+                cmds,
+                self._dbginternal(),
+            )
+            self._printer.commands(cmds)
+        elif cmd == "SMARTABLDECIDE" and self.machine.state == DECIDING:
+            cmds, state, drift = self._decide()
+            cmds = self._heat_cmds(cmds, state, drift)
+            if cmds is not None:
+                self._printer.commands(cmds)
+            self._cancel_query_timer()
+            self._transition(state, cmd, drift)
+        elif (
+            cmd == "SMARTABLDRIFT"
+            and self.machine.state == PROBING
+            and self.machine.drift
+        ):
+            elapsed = None
+            if self.drift_sent is not None:
+                elapsed = time.monotonic() - self.drift_sent
+                self.metrics.observe("drift_check_seconds", elapsed)
+                self.drift_sent = None
+            drift = self._drift()
+            threshold = self._get("drift_threshold", "f")
+            if drift is not None and drift <= threshold:
+                self.state["prints"] = 0
+                self.state["last_mesh"] = self._today()
+                self._save()
+                self._update_frontend()
+                cmds = None
+                self.metrics.inc("drift_checks_total", outcome="skip")
+                self._record("drift_skip", duration=elapsed, value=drift)
+                self._transition(IDLE, cmd)
+                self._log(
+                    "at_command:drift",
+                    " >> ABL skip > Drift(max=%.3f, threshold=%s) || %s",
+                    drift,
+                    threshold,
+                    self._dbgstate(),
+                    level=logging.INFO,
+                )
+            else:
+                cmds = self._abl_cmds()
+                self.metrics.inc("drift_checks_total", outcome="abl")
+                self._record(
+                    "drift_abl",
+                    reason="drift" if drift is not None else "no_probes",
+                    duration=elapsed,
+                    value=drift,
+                )
+                self._log(
+                    "at_command:drift",
+                    " >> ABL trigger >> Sending %s > "
+                    "Drift(max=%s, threshold=%s, probes=%s)",
+                    cmds,
+                    drift,
+                    threshold,
+                    self.probes,
+                    level=logging.INFO,
+                )
+                self._printer.commands(cmds)
+                self._transition(PROBING, cmd)
+        elif cmd == "SMARTABLRESET":
+            self.state["prints"] = 0
+            self.state["last_mesh"] = self._today()
+            self._save()
+            self._update_frontend()
+            self._log(
+                "at_command:reset",
+                " > %s || %s",
+                self._dbgstate(),
+                self._dbginternal(),
+            )
+
+    def _prefetch(self, event):
+        if (
+            not self._get("early_query")
+            or self.profile is None
+            or self.detecting == "caps"
+            or self._prefetch_fresh()
+        ):
+            return
+        with self.machine.lock:
+            if self.machine.state != IDLE:
+                return
+            self._transition(PREFETCHING, event)
+            cmds = self.profile.metadata["info"][0]
+            self._log("prefetch", " >> Mesh query(cmd=%s)", cmds)
+            self._printer.commands(cmds)
+
+    def _prefetch_fresh(self):
+        return (
+            self._get("early_query")
+            and self.prefetched is not None
+            and time.monotonic() - self.prefetched
+            <= self._get("early_query_age", "i")
+        )
+
+    def _decide_early(self, cmd, gcode):
+        self.queried = True
+        self.last_cmd = cmd
+        self._log(
+            "gcode_queuing:early",
+            " > Trigger(cmd=%s, gcode=%s, age=%.1fs) || %s",
+            cmd,
+            gcode,
+            time.monotonic() - self.prefetched,
+            self._dbg(),
+        )
+        # the mesh report is already known: the trigger is replaced by
+        # the decision without holding the job
+        self._transition(DECIDING, cmd, hold=False)
+        cmds, state, drift = self._decide()
+        cmds = self._heat_cmds(cmds, state, drift)
+        # the decision may probe or load another mesh
+        self.prefetched = None
+        self._transition(state, cmd, drift)
+        self._log("gcode_queuing:early_send", " >> Sending %s", cmds)
+        return cmds or [None]
+
+    def _defer_heat(self, cmd):
+        temp = parse_temp(cmd)
+        if (
+            not self._get("heat_probe")
+            or self.heat_wait is not None
+            or not self.profile.metadata.get("heat_probe", True)
+            or self.machine.state not in (IDLE, PREFETCHING)
+            or self._job_index() is None
+            or not self.job_index["triggers"]
+            or temp is None
+            or temp.target <= 0
+        ):
+            return [cmd]
+        # the decision on the trigger sends the wait
+        self.heat_wait = cmd
+        cmds = [f"M140 S{temp.target:g}"]
+        self._log(
+            "gcode_queuing:heat",
+            " > Trigger(cmd=%s) >> Sending %s || %s",
+            cmd,
+            cmds,
+            self._dbg(),
+        )
+        return cmds
+
+    def _heat_cmds(self, cmds, state, drift):
+        wait = self.heat_wait
+        if wait is None:
+            return cmds
+        self.heat_wait = None
+        if state != PROBING or drift:
+            # the drift check compares with a mesh probed at temperature
+            return [wait] + (cmds or [])
+        target = parse_temp(wait).target
+        fraction = min(max(self._get("heat_fraction", "f"), 0.0), 1.0)
+        # M190 sets the target too: restore it so it keeps heating
+        cmds = (
+            [f"M190 S{target * fraction:.0f}", f"M140 S{target:g}"]
+            + cmds
+            + [wait]
+        )
+        self._log(
+            "at_command:heat",
+            " >> Probing while heating > %s || %s",
+            cmds,
+            self._dbg(),
+        )
+        return cmds
+
+    def _decide(self):
+        cmds = None
+        state, drift = IDLE, False
+        entry = None
+        self.library_key = self._library_key()
+        predicted = self._predicted_drift()
+        reason = self._reason(predicted)
+        held = (
+            time.monotonic() - self.hold_start
+            if self.hold_start is not None
+            else None
+        )
+        if not (
+            self.state["abl_always"]
+            or self.probe_required
+            or self.state["first_time"]
+        ):
+            entry = self._library_entry()
+        forced = (
+            self.state["abl_always"]
+            or self.probe_required
+            or self.force_temp
+            or self.state["first_time"]
+            or not self.valid_mesh
+            or bool(self.mesh_issues)
+            or self._partial_uncovered()
+        )
+        if entry is not None:
+            # the library has a fresh mesh for this temperature/sheet
+            cmds = self._library_load_cmds(entry)
+            self.force_temp = False
+            self.state["prints"] = entry["prints"]
+            self.state["last_mesh"] = entry["last_mesh"]
+            self.library.touch(self.library_key)
+            self.metrics.inc("decisions_total", outcome="library")
+            self._record("library", reason=self.library_key, duration=held)
+            self._save()
+            self._update_frontend()
+            self._log(
+                "at_command:decide",
+                " >> ABL skip (library %s) >> Sending %s > %s",
+                self.library_key,
+                cmds,
+                self._dbg(),
+                level=logging.INFO,
+            )
+        elif forced or (
+            (
+                self._get("force_days")
+                and self._diff_days() >= self._get("days", "i")
+            )
+            or (
+                self._get("force_prints")
+                and self.state["prints"] >= self._get("prints", "i")
+            )
+            or reason == "predicted_drift"
+        ):
+            if not forced and self._drift_allowed():
+                # mesh is only old, check a few points before probing
+                cmds = self._drift_cmds()
+                if self.save_allowed:
+                    # G30 turns bed leveling off, load the mesh after it
+                    cmds[-1:-1] = self._load_cmds()
+                self.probes = []
+                self.drift_sent = time.monotonic()
+                state, drift = PROBING, True
+                self.metrics.inc("decisions_total", outcome="drift_check")
+                self._record(
+                    "drift_check",
+                    reason=reason,
+                    duration=held,
+                    value=predicted,
+                )
+                self._log(
+                    "at_command:decide",
+                    " >> Drift check >> Sending %s > %s",
+                    cmds,
+                    self._dbg(),
+                    level=logging.INFO,
+                )
+            else:
+                cmds = self._abl_cmds()
+                state = PROBING
+                self.metrics.inc("decisions_total", outcome="abl")
+                self._record(
+                    "abl", reason=reason, duration=held, value=predicted
+                )
+                self._log(
+                    "at_command:decide",
+                    " >> ABL trigger >> Sending %s > %s",
+                    cmds,
+                    self._dbg(),
+                    level=logging.INFO,
+                )
+        else:
+            if self.save_allowed:
+                cmds = self._load_cmds()
+            self.metrics.inc("decisions_total", outcome="skip")
+            self._record("skip", duration=held, value=predicted)
+            self._log(
+                "at_command:decide",
+                " >> ABL skip >> Sending %s > %s",
+                cmds,
+                self._dbg(),
+                level=logging.INFO,
+            )
+        return cmds, state, drift
+
     def _today(self):
         return date.today().strftime("%d/%m/%Y")
 
-    def _diff_days(self):
+    def _diff_days(self, last_mesh=None):
+        if last_mesh is None:
+            last_mesh = self.state["last_mesh"]
         return (
-            date.today()
-            - datetime.strptime(self.state["last_mesh"], "%d/%m/%Y").date()
+            date.today() - datetime.strptime(last_mesh, "%d/%m/%Y").date()
         ).days
 
     def _gcodes_abl(self):
         if self._get("trigger_custom"):
-            return [
-                gc.strip() for gc in self._get("trigger_gcode", "s").split(",")
-            ]
+            return self._gcodes_split("trigger_gcode")
         else:
-            if self.firmware != "marlin":
-                return [self.fw_metadata[self.firmware]["abl"]]
+            if self.profile is None:
+                return []
+            metadata = self.profile.metadata
+            if "load" not in metadata:
+                return [metadata["abl"]]
             else:
-                return [
-                    self.fw_metadata[self.firmware]["abl"],
-                    self.fw_metadata[self.firmware]["load"].split()[0],
-                ]
+                return [metadata["abl"], metadata["load"].split()[0]]
 
-    def _gcodes_temp(self):
-        return [self.temp[tmp] for tmp in self.temp]
+    def _check_temp(self, temp):
+        # only the first target of each heater in the print counts, the
+        # changes after the decision can't force the next one
+        if self.queried or temp.heater in self.temps_seen or temp.target <= 0:
+            return
+        self.temps_seen.add(temp.heater)
+        self.job_temps[temp.heater] = temp.target
+        setting = "bedtemp" if temp.heater == "bed" else "hetemp"
+        # compared with the temperature of the last mesh, so small
+        # changes can't add up print after print
+        reference = self.state["mesh_temps"].get(
+            temp.heater, self.state["last_temps"].get(temp.heater, 0)
+        )
+        if self._get(setting) and abs(temp.target - reference) > self._get(
+            "temp_tolerance", "f"
+        ):
+            self.force_temp = True
+        self.state["last_temps"][temp.heater] = temp.target
+        if temp.heater == "bed":
+            self.state["last_bedtemp"] = temp.target
+        elif temp.heater == "tool0":
+            self.state["last_hetemp"] = temp.target
+        self._save()
+        self._log(
+            f"gcode_sent:{setting}",
+            " > Temp(heater=%s, target=%s, reference=%s) > %s || %s",
+            temp.heater,
+            temp.target,
+            reference,
+            self._dbgstate(),
+            self._dbginternal(),
+        )
 
     def _gcodes_custom(self):
-        return [gc.strip() for gc in self._get("abl_gcode", "s").split(",")]
+        return self._gcodes_split("abl_gcode")
 
     def _gcodes_ignore(self):
-        return [gc.strip() for gc in self._get("ignore_gcode", "s").split(",")]
+        return self._gcodes_split("ignore_gcode")
+
+    def _gcodes_split(self, key):
+        return [
+            gc.strip()
+            for gc in (self._get(key, "s") or "").split(",")
+            if gc.strip()
+        ]
+
+    def _build_matcher(self):
+        # gcode_queuing runs for every line of the file, keep it to lookups
+        self.matcher = GcodeMatcher(
+            trigger=frozenset(self._gcodes_abl()),
+            ignore=frozenset(self._gcodes_ignore()),
+            custom=tuple(self._gcodes_custom()),
+            cmd_ignore=self._get("cmd_ignore"),
+            abl_custom=self._get("abl_custom"),
+        )
 
     def _get(self, key, ktype="b"):
-        if ktype == "i":
-            return self._settings.get_int([key])
+        if ktype == "i" or ktype == "f":
+            if ktype == "i":
+                value = self._settings.get_int([key])
+            else:
+                value = self._settings.get_float([key])
+            if value is None and key not in self.optional:
+                # cleared in the settings form
+                value = self.get_settings_defaults()[key]
+            return value
         elif ktype == "s":
             return self._settings.get([key])
         return self._settings.get_boolean([key])
 
+    def _log(self, tag, msg="", *args, level=logging.DEBUG):
+        # arguments are only formatted if the level is enabled
+        if self._smartabl_logger.isEnabledFor(level):
+            self._smartabl_logger.log(
+                level, f"@{tag}{msg}", *args, extra=dict(tag=tag)
+            )
+
+    def _set_log_level(self):
+        level = self._get("log_level", "s")
+        if level not in self.log_levels:
+            level = "DEBUG"
+        self._smartabl_logger.setLevel(level)
+
     def _dbg(self):
-        return (
-            f"{self._dbgsettings()} || "
-            f"{self._dbgstate()} || "
-            f"{self._dbginternal()}"
+        return Lazy(
+            lambda: (
+                f"{self._dbgsettings()} || "
+                f"{self._dbgstate()} || "
+                f"{self._dbginternal()}"
+            )
         )
 
     def _dbgsettings(self):
-        return (
-            f"Settings("
-            f"trigger_custom={self._get('trigger_custom')}, "
-            f"trigger_gcode={self._get('trigger_gcode', 's')}, "
-            f"abl_custom={self._get('abl_custom')}, "
-            f"abl_gcode={self._get('abl_gcode', 's')}, "
-            f"cmd_ignore={self._get('abl_custom')}, "
-            f"ignore_gcode={self._get('ignore_gcode', 's')}, "
-            f"force_days={self._get('force_days')}, "
-            f"days={self._get('days', 'i')}, "
-            f"force_prints={self._get('force_prints')}, "
-            f"prints={self._get('prints', 'i')}, "
-            f"failed={self._get('failed')}, "
-            f"bedtemp={self._get('bedtemp')}, "
-            f"hetemp={self._get('hetemp')}, "
-            f"force_unknown={self._get('force_unknown')}"
-            f")"
+        return Lazy(
+            lambda: (
+                f"Settings("
+                f"trigger_custom={self._get('trigger_custom')}, "
+                f"trigger_gcode={self._get('trigger_gcode', 's')}, "
+                f"abl_custom={self._get('abl_custom')}, "
+                f"abl_gcode={self._get('abl_gcode', 's')}, "
+                f"cmd_ignore={self._get('cmd_ignore')}, "
+                f"ignore_gcode={self._get('ignore_gcode', 's')}, "
+                f"force_days={self._get('force_days')}, "
+                f"days={self._get('days', 'i')}, "
+                f"force_prints={self._get('force_prints')}, "
+                f"prints={self._get('prints', 'i')}, "
+                f"failed={self._get('failed')}, "
+                f"bedtemp={self._get('bedtemp')}, "
+                f"hetemp={self._get('hetemp')}, "
+                f"force_unknown={self._get('force_unknown')}"
+                f")"
+            )
         )
 
     def _dbgstate(self):
-        return (
-            f"State("
-            f"first_time={self.state['first_time']}, "
-            f"prints={self.state['prints']}, "
-            f"last_mesh={self.state['last_mesh']}, "
-            f"abl_always={self.state['abl_always']}, "
-            f"last_bedtemp={self.state['last_bedtemp']}, "
-            f"last_hetemp={self.state['last_hetemp']}"
-            f")"
+        return Lazy(
+            lambda: (
+                f"State("
+                f"first_time={self.state['first_time']}, "
+                f"prints={self.state['prints']}, "
+                f"last_mesh={self.state['last_mesh']}, "
+                f"abl_always={self.state['abl_always']}, "
+                f"last_bedtemp={self.state['last_bedtemp']}, "
+                f"last_hetemp={self.state['last_hetemp']}"
+                f")"
+            )
         )
 
     def _dbginternal(self):
-        return (
-            f"Internal("
-            f"valid_mesh={self.valid_mesh}, "
-            f"cache={self.cache}, "
-            f"force_temp={self.force_temp}, "
-            f"firmware={self.firmware}, "
-            f"probe_required={self.probe_required}, "
-            f"save_allowed={self.save_allowed}, "
-            f"last_cmd={self.last_cmd}, "
-            f"querying={self.querying}"
-            f")"
+        return Lazy(
+            lambda: (
+                f"Internal("
+                f"valid_mesh={self.valid_mesh}, "
+                f"mesh_issues={self.mesh_issues}, "
+                f"state={self.machine.state}, "
+                f"force_temp={self.force_temp}, "
+                f"firmware={self.firmware}, "
+                f"capabilities={self.capabilities}, "
+                f"probe_required={self.probe_required}, "
+                f"save_allowed={self.save_allowed}, "
+                f"last_cmd={self.last_cmd}, "
+                f"queried={self.queried}"
+                f")"
+            )
         )
 
     def _events(self):
@@ -536,37 +1204,937 @@ class SmartABLPlugin(
             else ("PrintDone", "PrintFailed")
         )
 
+    def _state_path(self):
+        return f"{self.get_plugin_data_folder()}/state.json"
+
     def _save(self):
-        with open(f"{self.get_plugin_data_folder()}/state.json", "w") as f:
-            json.dump(self.state, f)
+        # snapshot now, write later: callers may be on the comm thread,
+        # the others change the state holding the lock
+        with self.machine.lock:
+            data = json.dumps(self.state)
+        self.writer.schedule("state", atomic_write, self._state_path(), data)
+
+    def _status(self):
+        return dict(
+            abl_always=self.state["abl_always"],
+            prints=self.state["prints"],
+            prints_limit=self._get("prints", "i"),
+            last_mesh=self.state["last_mesh"],
+            mesh_age=self._diff_days(),
+            first_time=self.state["first_time"],
+            firmware=self.firmware,
+            capabilities=dict(self.capabilities),
+            save_allowed=self.save_allowed,
+            probe_required=self.probe_required,
+            valid_mesh=self.valid_mesh,
+            mesh_issues=list(self.mesh_issues),
+            machine=self.machine.state,
+            mesh_id=self.meshes.last.id if self.meshes.last else None,
+            last_decision=self.last_decision,
+        )
+
+    def _status_body(self):
+        status = self._status()
+        with self.status_lock:
+            # serialized and hashed only when something changed
+            if status != self.status_cache[0]:
+                body = json.dumps(status, sort_keys=True)
+                etag = hashlib.sha1(body.encode()).hexdigest()
+                self.status_cache = (status, body, etag)
+            return self.status_cache[1:]
+
+    def _heatmap_meshes(self):
+        meshes = self.meshes.meshes[-2:]
+        if not meshes:
+            return None, None
+        return meshes[-1], meshes[0] if len(meshes) > 1 else None
+
+    def _heatmap(self, request):
+        mesh, previous = self._heatmap_meshes()
+        if mesh is None:
+            return flask.abort(404)
+        kind = request.args.get("heatmap") or "json"
+        if kind not in ("json", "png", "delta"):
+            return flask.abort(400)
+        body = self.heatmaps.get(kind, mesh, previous)
+        if body is None:
+            return flask.abort(404)
+        response = flask.Response(
+            body,
+            mimetype="application/json" if kind == "json" else "image/png",
+        )
+        response.set_etag(
+            f"{kind}-{mesh.id}-{previous.id if previous else None}"
+        )
+        return response.make_conditional(request)
+
+    def _warm_heatmap(self):
+        mesh, previous = self._heatmap_meshes()
+        if mesh is None:
+            return
+        try:
+            self.heatmaps.warm(mesh, previous)
+        except Exception:
+            self._smartabl_logger.exception(
+                "@heatmap > Error rendering mesh %s", mesh.id
+            )
 
     def _update_frontend(self):
-        self._plugin_manager.send_plugin_message(
-            self._identifier,
-            {"abl_counter": (self.state["prints"], self._get("prints", "i"))},
+        with self.status_lock:
+            if self.status_timer is not None or self.scheduler is None:
+                return
+            self.status_timer = self.scheduler.call_later(
+                self.push_delay, self._push_status
+            )
+
+    def _push_status(self):
+        status = self._status()
+        with self.status_lock:
+            self.status_timer = None
+            delta = {
+                key: value
+                for key, value in status.items()
+                if key not in self.status_pushed
+                or self.status_pushed[key] != value
+            }
+            self.status_pushed = status
+        if delta:
+            self._plugin_manager.send_plugin_message(
+                self._identifier, {"status": delta}
+            )
+
+    def _transition(self, target, event, drift=False, hold=None):
+        source = self.machine.state
+        if not self.machine.transition(target, event, drift):
+            self._log(
+                "transition",
+                " > Rejected %s -> %s (%s)",
+                source,
+                target,
+                event,
+                level=logging.WARNING,
+            )
+            return False
+        self._log("transition", " > %s -> %s (%s)", source, target, event)
+        if hold is None:
+            # the job waits for the decision and for the drift check points
+            hold = target in (QUERYING, DECIDING) or drift
+        self._hold(hold)
+        if target != source:
+            self._update_frontend()
+        return True
+
+    def _reset(self, event):
+        with self.machine.lock:
+            if self.machine.reset(event):
+                self._log("transition", " > reset (%s)", event)
+            self._cancel_query_timer()
+            self._hold(False)
+
+    def _hold(self, value):
+        if value == self.held:
+            return
+        self.held = value
+        if value:
+            self.hold_start = time.monotonic()
+        elif self.hold_start is not None:
+            self.metrics.observe(
+                "hold_seconds", time.monotonic() - self.hold_start
+            )
+            self.hold_start = None
+        self._printer.set_job_on_hold(value)
+
+    def _reason(self, predicted=None):
+        for reason, value in (
+            ("abl_always", self.state["abl_always"]),
+            ("probe_required", self.probe_required),
+            ("temperature", self.force_temp),
+            ("first_time", self.state["first_time"]),
+            ("invalid_mesh", not self.valid_mesh),
+            ("mesh_quality", bool(self.mesh_issues)),
+            ("partial_mesh", self._partial_uncovered()),
+            (
+                "days",
+                self._get("force_days")
+                and self._diff_days() >= self._get("days", "i"),
+            ),
+            (
+                "prints",
+                self._get("force_prints")
+                and self.state["prints"] >= self._get("prints", "i"),
+            ),
+            (
+                "predicted_drift",
+                predicted is not None
+                and predicted > self._get("drift_threshold", "f"),
+            ),
+        ):
+            if value:
+                return reason
+        return None
+
+    def _record(self, outcome, **fields):
+        self.last_decision = dict(
+            outcome=outcome, reason=fields.get("reason"), time=time.time()
+        )
+        self._update_frontend()
+        if self.history is None:
+            return
+        self.history.record(
+            outcome,
+            firmware=self.firmware,
+            bedtemp=self.job_temps.get("bed", self.state["last_bedtemp"]),
+            hetemp=self.job_temps.get("tool0", self.state["last_hetemp"]),
+            file=self.job_file,
+            prints=self.state["prints"],
+            days=self._diff_days(),
+            **fields,
         )
 
-    def _unlock_queue(self):
-        if not self.event.wait(15):
-            self._smartabl_logger.debug(
-                "@unlock_queue >> Sending @SMARTABLDECIDE"
+    def _gauges(self):
+        # skipped probes valued at the average duration of the real ones
+        skipped = sum(
+            self.metrics.counter("decisions_total", outcome=outcome)
+            for outcome in ("skip", "library")
+        ) + self.metrics.counter("drift_checks_total", outcome="skip")
+        return dict(
+            abl_seconds_avoided=skipped * self.metrics.mean("abl_seconds"),
+            prints=self.state["prints"],
+        )
+
+    def _abl_cmds(self):
+        self.abl_sent = time.monotonic()
+        self.force_temp = False
+        self.probe_required = False
+        if "M420" in self.last_cmd:
+            cmds = [self.profile.metadata["abl"]]
+        else:
+            cmds = [self.last_cmd]
+        self.region = None
+        if self.matcher.abl_custom:
+            cmds = list(self.matcher.custom)
+        elif len(cmds[0].split()) == 1:  # file ABL without parameters
+            self.region = self._abl_region()
+            if self.region is not None:
+                cmds = [
+                    self.profile.metadata["abl_region"].format(**self.region)
+                ]
+        cmds.append("@SMARTABLSAVE")
+        return cmds
+
+    def _load_cmds(self):
+        if "load" not in self.profile.metadata:  # the mesh stays active
+            return []
+        if self.last_cmd.startswith("M420 S1 Z"):
+            return [self.last_cmd]
+        return [self.profile.metadata["load"]]
+
+    def _persist_mesh(self):
+        self.persist_pending = False
+        self.state["persisted"][self.port] = self._get("save_config")
+        self._save()
+        if not self._get("save_config"):
+            self._log(
+                "on_event:persist",
+                " > Mesh saved until the firmware restarts",
+                level=logging.INFO,
             )
-            self._printer.commands("@SMARTABLDECIDE")
+            return
+        cmds = self.profile.metadata["persist"]
+        self._log(
+            "on_event:persist",
+            " >> Sending %s > %s",
+            cmds,
+            self._dbginternal(),
+            level=logging.INFO,
+        )
+        self._printer.commands(cmds)
+        self.library.persist()
+        self._save()
 
-    def _line_mesh(self, line):
-        for text in self.fw_metadata[self.firmware]["info"][1]:
-            if text in line:
-                return True
-        for text in self.fw_metadata[self.firmware]["info"][2]:
-            if text in line:
-                return True
-        return False
+    def _drop_volatile(self, reason):
+        dropped = self.library.drop_volatile()
+        if dropped:
+            self._log(
+                "library_drop",
+                " > Slots lost on firmware restart > Library(keys=%s, by=%s)",
+                dropped,
+                reason,
+                level=logging.INFO,
+            )
+            self._save()
 
-    def _valid_mesh(self, line):
-        for text in self.fw_metadata[self.firmware]["info"][2]:
-            if text in line:
-                return True
-        return False
+    def _drift_allowed(self):
+        return (
+            self._get("drift_check")
+            and "probe" in self.profile.metadata
+            and self.meshes.last is not None
+            # the stored mesh doesn't match the bed after a partial one
+            and self.state["partial_mesh"] is None
+            # the probed points are placed and compared in the probe area
+            and self._probe_bounds(self.meshes.last) is not None
+        )
+
+    def _drift_points(self, bounds):
+        points = []
+        for point in (self._get("drift_points", "s") or "").split(";"):
+            try:
+                x, y = (float(coord) for coord in point.split(","))
+            except ValueError:
+                continue
+            points.append((x, y))
+        if not points:
+            min_x, min_y, max_x, max_y = bounds
+            width, depth = max_x - min_x, max_y - min_y
+            points = [
+                (min_x + width * fx, min_y + depth * fy)
+                for fx, fy in (
+                    (0.5, 0.5),
+                    (0.2, 0.2),
+                    (0.8, 0.2),
+                    (0.2, 0.8),
+                    (0.8, 0.8),
+                )
+            ]
+        return points
+
+    def _drift_cmds(self):
+        templates = self.profile.metadata["probe"][0]
+        cmds = []
+        for x, y in self._drift_points(self._probe_bounds(self.meshes.last)):
+            cmds.extend(tmpl.format(x=x, y=y) for tmpl in templates)
+        cmds.append("@SMARTABLDRIFT")
+        return cmds
+
+    def _drift(self):
+        mesh = self.meshes.last
+        if mesh is None or not self.probes:
+            return None
+        bounds = self._probe_bounds(mesh)
+        if bounds is None:
+            return None
+        return drift(mesh, bounds, self.probes)
+
+    def _usage(self):
+        usage = self.state["usage"]
+        hours = usage["hours"]
+        if self.job_start is not None:
+            hours += (time.monotonic() - self.job_start) / 3600
+        return (usage["prints"], hours, usage["cycles"])
+
+    def _predicted_drift(self):
+        if not self._get("predict") or not self.meshes.meshes:
+            return None
+        key = (len(self.meshes.meshes), self.meshes.last.id)
+        if key != self.drift_model_key:
+            # refit only when a mesh was added
+            self.drift_model = fit(
+                self.meshes.meshes, self._get("temp_tolerance", "f")
+            )
+            self.drift_model_key = key
+        ref = reference(
+            self.meshes.meshes,
+            self._bedtemp(),
+            self._get("temp_tolerance", "f"),
+        )
+        if self.drift_model is None or ref is None:
+            return None
+        predicted = self.drift_model.predict(
+            usage_features(ref, time.time(), self._usage())
+        )
+        self._log(
+            "predict",
+            " > Drift(predicted=%.3f, model=%s, reference=%s)",
+            predicted,
+            self.drift_model,
+            ref.id,
+        )
+        return predicted
+
+    def _footprint(self):
+        if self._job_index() is None:
+            return None
+        return self.job_index.get("footprint")
+
+    def _abl_region(self):
+        metadata = self.profile.metadata
+        reports = metadata.get("region_reports")
+        footprint = self._footprint()
+        if (
+            not self._get("adaptive")
+            or not metadata.get("abl_region")
+            or footprint is None
+            or reports is not None
+            and self.mesh_report not in reports
+        ):
+            return None
+        bounds = self._probe_bounds(self.meshes.last)
+        if bounds is None:
+            # the firmware refuses a region outside of its probe area
+            return None
+        min_x, min_y, max_x, max_y = bounds
+        margin = self._get("adaptive_margin", "f")
+        region = dict(
+            min_x=max(footprint[0] - margin, min_x),
+            min_y=max(footprint[1] - margin, min_y),
+            max_x=min(footprint[2] + margin, max_x),
+            max_y=min(footprint[3] + margin, max_y),
+        )
+        area = (region["max_x"] - region["min_x"]) * (
+            region["max_y"] - region["min_y"]
+        )
+        # not worth a partial mesh if the print covers most of the bed
+        if area >= 0.8 * (max_x - min_x) * (max_y - min_y):
+            return None
+        return region
+
+    def _partial_uncovered(self):
+        partial = self.state["partial_mesh"]
+        if partial is None:
+            return False
+        footprint = self._footprint()
+        return (
+            footprint is None
+            or footprint[0] < partial["min_x"]
+            or footprint[1] < partial["min_y"]
+            or footprint[2] > partial["max_x"]
+            or footprint[3] > partial["max_y"]
+        )
+
+    def _probe_bounds(self, mesh):
+        # reported by the firmware or set by the user, None if unknown
+        if mesh is not None and mesh.bounds is not None:
+            return mesh.bounds
+        try:
+            min_x, min_y, max_x, max_y = (
+                float(coord)
+                for coord in self._get("mesh_bounds", "s").split(",")
+            )
+        except (AttributeError, ValueError):
+            return None
+        return (min_x, min_y, max_x, max_y)
+
+    def _library_slots(self):
+        metadata = self.profile.metadata
+        return "slot_load" in metadata and (
+            "slots" not in metadata or self.mesh_slots
+        )
+
+    def _library_key(self):
+        if not self._get("library") or not (
+            self._library_slots() or "upload" in self.profile.metadata
+        ):
+            return None
+        return MeshLibrary.key(
+            self._bedtemp(),
+            self._get("temp_band", "i"),
+            self._get("sheet", "s"),
+        )
+
+    def _library_entry(self):
+        if "persist" in self.profile.metadata and not self.valid_mesh:
+            # nothing loaded, the firmware restarted since the slots were saved
+            self._drop_volatile("query")
+        entry = self.library.get(self.library_key)
+        if (
+            entry is None
+            or (
+                self._get("force_days")
+                and self._diff_days(entry["last_mesh"])
+                >= self._get("days", "i")
+            )
+            or (
+                self._get("force_prints")
+                and entry["prints"] >= self._get("prints", "i")
+            )
+            or not self._library_load_cmds(entry)
+        ):
+            return None
+        return entry
+
+    def _library_load_cmds(self, entry):
+        metadata = self.profile.metadata
+        if self._library_slots() and entry.get("slot_saved"):
+            return [
+                cmd.format(slot=entry["slot"]) for cmd in metadata["slot_load"]
+            ]
+        # no slot written, send the stored mesh point by point
+        mesh = self.meshes.get(entry["mesh_id"])
+        if mesh is None or "upload" not in metadata:
+            return []
+        cmds = [
+            metadata["upload"].format(i=i, j=j, z=float(mesh.z[j, i]))
+            for j, i in zip(*np.nonzero(~np.isnan(mesh.z)))
+        ]
+        return cmds + [metadata["load"]]
+
+    def _library_store(self):
+        if self.library_key is None:
+            return
+        entry = self.library.store(self.library_key, self._today())
+        if self._library_slots():
+            self._library_slot_save(entry)
+
+    def _library_slot_save(self, entry):
+        cmds = [
+            cmd.format(slot=entry["slot"])
+            for cmd in self.profile.metadata["slot_save"]
+        ]
+        entry["slot_saved"] = True
+        # slots kept in memory until the persist command (klipper)
+        entry["persisted"] = "persist" not in self.profile.metadata
+        self._log(
+            "library_store",
+            " >> Sending %s > Library(key=%s, entry=%s)",
+            cmds,
+            self.library_key,
+            entry,
+        )
+        self._printer.commands(cmds)
+
+    def _bedtemp(self):
+        temps = self._printer.get_current_temperatures()
+        target = temps.get("bed", {}).get("target")
+        if not target and self._job_index() is not None:
+            # bed not heated yet, use the target found in the file
+            target = self.job_index["temps"].get("bed")
+        return target if target else self.state["last_bedtemp"]
+
+    def _marked(self, path):
+        # marked with the current settings, the rest are checked live
+        try:
+            with open(path, "rb") as f:
+                first = f.readline(512)
+        except OSError:
+            return False
+        return first.strip() == header(self.matcher).encode()
+
+    def _local_path(self, payload):
+        if (
+            not payload
+            or payload.get("storage", payload.get("origin")) != "local"
+            or "gcode" not in payload.get("type", ["gcode"])
+        ):
+            return None
+        try:
+            return self._file_manager.path_on_disk("local", payload["path"])
+        except Exception:
+            return None
+
+    def _job_index(self):
+        # the scan started when the file was selected may end after
+        # the print started
+        if self.job_index is None and self.job_key is not None:
+            self.job_index = self.prescan.get(self.job_key)
+            self._check_index_temps()
+        return self.job_index
+
+    def _check_index_temps(self):
+        if self.job_index is not None:
+            # temperatures known before the print reaches them
+            for heater, target in self.job_index["temps"].items():
+                gcode = self.temp["bed" if heater == "bed" else "he"]
+                self._check_temp(TempTarget(gcode, heater, target, True))
+
+    def _prescan_file(self, path):
+        matcher = self.matcher
+        try:
+            key = PrescanIndex.key(path, matcher)
+        except OSError:
+            return None
+        entry = self.prescan.get(key)
+        if entry is None:
+            start = time.monotonic()
+            try:
+                entry = scan(path, matcher, frozenset(self.temp.values()))
+            except OSError:
+                self._smartabl_logger.exception(f"@prescan > Error in {path}")
+                return None
+            self.metrics.observe("prescan_seconds", time.monotonic() - start)
+            self.writer.schedule(
+                "prescan", self.prescan.save, self.prescan.put(key, entry)
+            )
+            self._log(
+                "prescan",
+                " > Index(file=%s, lines=%s, triggers=%s, temps=%s)",
+                path,
+                entry["lines"],
+                entry["triggers"][:5],
+                entry["temps"],
+            )
+        return entry
+
+    def _capture_mesh(self):
+        if self.firmware is None:
+            self._transition(IDLE, "no_firmware")
+        else:
+            cmds = self.profile.metadata["info"][0]
+            self._log("capture_mesh", " >> Mesh query(cmd=%s)", cmds)
+            self._printer.commands(cmds)
+
+    def _mesh_parsed(self):
+        mesh = self.mesh_parser.mesh(
+            time.time(),
+            self._bedtemp(),
+            self._usage() if self.machine.state == SAVING else None,
+        )
+        if mesh is None:
+            self._log(
+                "mesh_parsed:error",
+                " > %s",
+                self.mesh_parser.error or "Empty mesh",
+            )
+        elif self.state["partial_mesh"] is not None:
+            # reported again by every query until the whole bed is probed,
+            # the grid doesn't cover the probe area of the stored meshes
+            self._log(
+                "mesh_parsed:partial",
+                " > Mesh(shape=%s, region=%s) not stored",
+                mesh.z.shape,
+                self.state["partial_mesh"],
+            )
+        else:
+            self._check_quality(mesh)
+            if self.meshes.append(mesh):
+                self.writer.schedule(
+                    "meshes", self.meshes.save, self.meshes.snapshot()
+                )
+                # rendered once, browsers only get the cached payloads
+                self.prescanner.submit(self._warm_heatmap)
+                self._log(
+                    "mesh_parsed:stored",
+                    " > Mesh(id=%s, shape=%s, bounds=%s, bedtemp=%s)",
+                    mesh.id,
+                    mesh.z.shape,
+                    mesh.bounds,
+                    mesh.bedtemp,
+                )
+        entry = self.library.get(self.library_key)
+        if (
+            mesh is not None
+            and self.machine.state == SAVING
+            and entry is not None
+            and self.state["partial_mesh"] is None
+        ):
+            # mesh probed for this library entry
+            entry["mesh_id"] = self.meshes.last.id
+            if not entry.get("slot_saved") and self._library_slots():
+                # the report after probing is the first one with slots
+                self._library_slot_save(entry)
+            self._save()
+        self.mesh_parser = None
+        self._mesh_reported()
+
+    def _check_quality(self, mesh):
+        if not self._get("quality_check"):
+            return
+        result = quality(mesh.z)
+        self.mesh_issues = result.issues(
+            dict(
+                range=self._get("quality_range", "f"),
+                residual=self._get("quality_residual", "f"),
+                outlier=self._get("quality_outlier", "f"),
+                missing=self._get("quality_missing", "i"),
+            )
+        )
+        if not self.mesh_issues:
+            self._log("mesh_quality", " > %s", result)
+            return
+        self._log(
+            "mesh_quality",
+            " > %s > Issues(%s), bed leveling forced",
+            result,
+            self.mesh_issues,
+            level=logging.WARNING,
+        )
+        if self.machine.state == SAVING:
+            # the mesh just probed is already wrong
+            self._plugin_manager.send_plugin_message(
+                self._identifier,
+                {
+                    "abl_notify": (
+                        "SmartABL: bad mesh",
+                        "The new mesh failed the checks "
+                        f"({', '.join(self.mesh_issues)}), "
+                        "check the probe and the bed.",
+                    )
+                },
+            )
+        self._update_frontend()
+
+    def _mesh_matched(self, text):
+        matcher = self.profile.mesh
+        state = self.machine.state
+        if state == QUERYING:
+            self._cancel_query_timer()
+            self._record_rtt()
+        elif state != SAVING and state != PREFETCHING:
+            # answered after the timeout: slow, not missing
+            self.query_late = False
+            self._record_rtt()
+            self._save()
+            return
+        elif self.state["misses"].pop(self.firmware, None) is not None:
+            # the firmware answers the query, the full timeout is used again
+            self._save()
+        self.valid_mesh = text in matcher.valid
+        self.mesh_issues = []
+        if not self.valid_mesh and self._reload_mesh(state):
+            return
+        if self.valid_mesh:
+            self.mesh_report = text
+            self.mesh_slots = text in self.profile.metadata.get("slots", ())
+            # wait for the grid before deciding
+            self.mesh_parser = MeshParser(
+                text in self.profile.metadata["reverse"]
+            )
+        else:
+            self._mesh_reported()
+
+    def _reload_mesh(self, state):
+        metadata = self.profile.metadata
+        if (
+            state == SAVING
+            or self.reloaded
+            or "reload" not in metadata
+            or not self.state["persisted"].get(self.port)
+        ):
+            return False
+        # the firmware restarted, the persisted mesh is loaded by hand
+        self.reloaded = True
+        cmds = [
+            metadata["reload"],
+            ("@SMARTABLQUERY" if state == QUERYING else metadata["info"][0]),
+        ]
+        self._log(
+            "process_line:reload",
+            " >> Sending %s > %s",
+            cmds,
+            self._dbginternal(),
+            level=logging.INFO,
+        )
+        self._printer.commands(cmds)
+        return True
+
+    def _mesh_reported(self):
+        self.reloaded = False
+        if self.machine.state in (SAVING, PREFETCHING):
+            # the mesh in memory is known until the next probe or load
+            self.prefetched = time.monotonic()
+            self._transition(
+                IDLE,
+                (
+                    "mesh_captured"
+                    if self.machine.state == SAVING
+                    else "mesh_prefetched"
+                ),
+            )
+        elif self.machine.state == QUERYING and self._transition(
+            DECIDING, "mesh_reported"
+        ):
+            cmds = "@SMARTABLDECIDE"
+            self._log(
+                f"process_line:{'' if self.valid_mesh else 'in'}valid_mesh",
+                " >> Sending %s > %s",
+                cmds,
+                self._dbginternal(),
+            )
+            self._printer.commands(cmds)
+
+    def _set_profile(self, profile):
+        self.profile = profile
+        self.firmware = profile.name
+        self.save_allowed = profile.save_allowed
+        self.probe_required = profile.probe_required
+        self._build_matcher()
+
+    def _detect(self, line):
+        self._log("process_line:firmware", " >> %s", line)
+        profile = self.profiles.detect(line)
+        if profile is None and self._get("force_unknown"):
+            profile = self.profiles.get("marlin")
+            self._log(
+                "process_line:detected_firmware",
+                " >> unknown* > marlin",
+                level=logging.INFO,
+            )
+        if profile is None:
+            self.firmware = self.profile = None
+            self.detecting = False
+            self._log(
+                "process_line:detected_firmware",
+                " >> unknown",
+                level=logging.WARNING,
+            )
+            self._plugin_manager.send_plugin_message(
+                self._identifier,
+                {
+                    "abl_notify": (
+                        "SmartABL: disabled",
+                        "Unknown firmware. Open an Issue "
+                        "on GitHub indicating your "
+                        "firmware and logs. Or force SmartABL"
+                        "on unknown firmware, check settings "
+                        "for more info.",
+                    )
+                },
+            )
+            return
+        self._set_profile(profile)
+        self.banner = line
+        self.capabilities = {}
+        # Cap: lines of the M115 report follow
+        self.detecting = "caps"
+        self._log(
+            "process_line:detected_firmware",
+            " >> %s > %s",
+            profile.name,
+            self._dbginternal(),
+            level=logging.INFO,
+        )
+
+    def _detect_line(self, line):
+        if "FIRMWARE_NAME" in line:
+            if line != self.banner:  # not the firmware in the cache
+                self._detect(line)
+            else:
+                self.capabilities = {}
+                self.detecting = "caps"
+        elif self.detecting == "caps":
+            cap = parse_cap(line)
+            if cap is not None:
+                self.capabilities[cap[0]] = cap[1]
+            else:
+                self.detecting = False
+                self._apply_capabilities()
+                self._cache_firmware()
+                self._prefetch("detected")
+
+    def _apply_capabilities(self):
+        caps = self.capabilities
+        # capabilities the profile only saves with if reported
+        required = self.profile.metadata.get("save_caps", ())
+        self.save_allowed = (
+            self.profile.save_allowed
+            and caps.get("EEPROM", True)
+            and all(caps.get(cap) for cap in required)
+        )
+        # the mesh can't be checked if the firmware can't report it
+        if caps.get("LEVELING_DATA") is False:
+            self.probe_required = True
+        if caps.get("AUTOLEVEL") is False:
+            self._log(
+                "process_line:capabilities",
+                " > Firmware without auto bed leveling",
+                level=logging.WARNING,
+            )
+        self._log(
+            "process_line:capabilities",
+            " > Capabilities(%s) > %s",
+            caps,
+            self._dbginternal(),
+            level=logging.INFO,
+        )
+        self._update_frontend()
+
+    def _cache_firmware(self):
+        if self.port is None or self.profile is None or self.detecting:
+            return
+        self.state["firmwares"][self.port] = dict(
+            profile=self.profile.name,
+            banner=self.banner,
+            uuid=firmware_uuid(self.banner or ""),
+            capabilities=self.capabilities,
+        )
+        self._save()
+
+    def _restore_firmware(self):
+        cached = self.state["firmwares"].get(self.port)
+        if cached is None:
+            return
+        profile = self.profiles.get(cached["profile"])
+        if profile is None:
+            return
+        self._set_profile(profile)
+        self.banner = cached["banner"]
+        self.capabilities = dict(cached["capabilities"])
+        self._apply_capabilities()
+        # keep an eye on the M115 report in case the firmware changed
+        self.detecting = "banner"
+        self._log(
+            "on_event:firmware_cached",
+            " >> %s(port=%s) > %s",
+            profile.name,
+            self.port,
+            self._dbginternal(),
+            level=logging.INFO,
+        )
+
+    def _timeout(self):
+        rtts = self.state["rtt"].get(self.firmware)
+        ceiling = self.query_timeout["ceiling"]
+        if (
+            self.state["misses"].get(self.firmware, 0)
+            >= self.query_timeout["misses"]
+        ):
+            # the query isn't answered, don't hold every print for it
+            return self.query_timeout["floor"]
+        if not rtts or len(rtts) < 5:
+            return ceiling
+        timeout = np.percentile(rtts, 99) * self.query_timeout["factor"]
+        return float(min(max(timeout, self.query_timeout["floor"]), ceiling))
+
+    def _record_rtt(self):
+        if self.query_sent is None:
+            return
+        rtt = time.monotonic() - self.query_sent
+        self.metrics.observe("query_rtt_seconds", rtt)
+        rtts = self.state["rtt"].setdefault(self.firmware, [])
+        rtts.append(round(rtt, 3))
+        del rtts[: -self.query_timeout["samples"]]
+        self.state["misses"].pop(self.firmware, None)
+        self.query_sent = None
+
+    def _arm_query_timer(self):
+        self._cancel_query_timer()
+        self.query_late = False
+        timeout = self._timeout()
+        self.query_timer = self.scheduler.call_later(
+            timeout, self._query_expired
+        )
+        self._log("arm_query_timer", " > Timeout(%.2fs)", timeout)
+
+    def _cancel_query_timer(self):
+        if self.query_timer is not None:
+            self.query_timer.cancel()
+            self.query_timer = None
+
+    def _query_expired(self):
+        with self.machine.lock:
+            timer = self.query_timer
+            # the report may have arrived, or the timer been rearmed,
+            # while waiting for the lock
+            if (
+                timer is None
+                or timer.deadline > time.monotonic()
+                or self.machine.state != QUERYING
+            ):
+                return
+            self.query_timer = None
+            # query_sent kept to time the report if it comes late
+            self.query_late = True
+            self.mesh_parser = None
+            self.metrics.inc("query_timeouts_total", firmware=self.firmware)
+            misses = self.state["misses"]
+            misses[self.firmware] = misses.get(self.firmware, 0) + 1
+            self._save()
+            self._log(
+                "query_expired",
+                " >> Sending @SMARTABLDECIDE",
+                level=logging.WARNING,
+            )
+            self._transition(DECIDING, "query_expired")
+            self._printer.commands("@SMARTABLDECIDE")
 
 
 __plugin_pythoncompat__ = ">=3.7,<4"
@@ -591,6 +2159,9 @@ def __plugin_load__():
         "octoprint.comm.protocol.gcode.sent": (
             __plugin_implementation__.gcode_sent
         ),
+        "octoprint.filemanager.preprocessor": (
+            __plugin_implementation__.preprocess
+        ),
         "octoprint.plugin.softwareupdate.check_config": (
             __plugin_implementation__.get_update_information
         ),
@@ -0,0 +1,232 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import glob
+import json
+import logging
+import os
+import re
+from typing import FrozenSet, NamedTuple, Optional, Tuple
+
+# checked in order, the most specific name first: prusa firmwares
+# say "based on Marlin" and buddy is also a prusa firmware
+BUILTIN = [
+    {
+        "name": "prusa-buddy",
+        "extends": "marlin",
+        "match": ["prusa-firmware-buddy"],
+        "abl_region": None,
+        # M500 only if the firmware reports its storage
+        "save_caps": ["EEPROM"],
+        # load cell probing is disturbed by the heaters
+        "heat_probe": False,
+    },
+    {
+        "name": "prusa",
+        "match": ["prusa"],
+        "save_allowed": False,
+        "probe_required": True,
+        "abl": "G80",
+        # PINDA readings depend on the bed temperature
+        "heat_probe": False,
+        "info": [
+            "G81",
+            ["Mesh bed leveling not active"],
+            ["Measured points"],
+        ],
+        "reverse": ["Measured points"],
+    },
+    {
+        "name": "klipper",
+        "match": ["klipper"],
+        "abl": "BED_MESH_CALIBRATE",
+        "abl_region": (
+            "BED_MESH_CALIBRATE MESH_MIN={min_x:.1f},{min_y:.1f} "
+            "MESH_MAX={max_x:.1f},{max_y:.1f}"
+        ),
+        "info": [
+            "BED_MESH_OUTPUT",
+            ["Bed has not been probed"],
+            ["Mesh Leveling Probed Z positions"],
+        ],
+        "reverse": [],
+        # the mesh stays active until klipper restarts, it doesn't load
+        # "default" when it starts
+        "save": "BED_MESH_PROFILE SAVE=default",
+        # sent when nothing is loaded and "default" was persisted
+        "reload": "BED_MESH_PROFILE LOAD=default",
+        # written to printer.cfg restarting klipper, only after the print
+        "persist": "SAVE_CONFIG",
+        "slot_save": ["BED_MESH_PROFILE SAVE=smartabl_{slot}"],
+        "slot_load": ["BED_MESH_PROFILE LOAD=smartabl_{slot}"],
+        "probe": [
+            ["G0 Z5 F600", "G0 X{x:.2f} Y{y:.2f} F6000", "PROBE"],
+            r"probe at (?P<x>[-\d.]+),(?P<y>[-\d.]+) is z=(?P<z>[-\d.]+)",
+        ],
+    },
+    {
+        "name": "marlin",
+        "match": ["marlin"],
+        "abl": "G29",
+        "abl_region": (
+            "G29 L{min_x:.0f} R{max_x:.0f} F{min_y:.0f} B{max_y:.0f}"
+        ),
+        # L is the slot to load in UBL, only bilinear probes a region
+        "region_reports": ["Bilinear Leveling Grid"],
+        "load": "M420 S1",
+        "info": [
+            "M420 V1",
+            ["Invalid mesh"],
+            ["Bilinear Leveling Grid", "Bed Topography Report"],
+        ],
+        # reports printing the back row of the bed first
+        "reverse": ["Bed Topography Report"],
+        # slots only available if the mesh comes from these reports
+        "slots": ["Bed Topography Report"],
+        "slot_save": ["G29 S{slot}"],
+        "slot_load": ["G29 L{slot}", "M420 S1"],
+        "upload": "M421 I{i} J{j} Z{z:.4f}",
+        "save": "M500",
+        "probe": [
+            ["G30 X{x:.2f} Y{y:.2f}"],
+            r"Bed X:\s*(?P<x>[-\d.]+)\s+Y:\s*(?P<y>[-\d.]+)"
+            r"\s+Z:\s*(?P<z>[-\d.]+)",
+        ],
+    },
+]
+# everything else in a profile is firmware metadata
+PROFILE_KEYS = ("name", "extends", "match", "save_allowed", "probe_required")
+REQUIRED = ("abl", "info", "reverse")
+
+FIELD_REGX = re.compile(r"\b([A-Z_]+):")
+CAP_REGX = re.compile(r"^Cap:\s*([A-Z_0-9]+)\s*:\s*([01])")
+
+
+class MeshMatcher(NamedTuple):
+    regx: "re.Pattern"
+    valid: FrozenSet[str]
+
+    @classmethod
+    def compile(cls, info):
+        # single pass over the line, the matched text tells the outcome
+        return cls(
+            re.compile(
+                "|".join(re.escape(text) for text in info[1] + info[2])
+            ),
+            frozenset(info[2]),
+        )
+
+
+class FirmwareProfile(NamedTuple):
+    name: str
+    match: Tuple[str, ...]
+    metadata: dict
+    mesh: MeshMatcher
+    probe: Optional["re.Pattern"]
+    save_allowed: bool
+    probe_required: bool
+
+    @classmethod
+    def compile(cls, data):
+        metadata = {k: v for k, v in data.items() if k not in PROFILE_KEYS}
+        missing = [key for key in REQUIRED if key not in metadata]
+        if missing:
+            raise ValueError(f"{data.get('name')}: missing {missing}")
+        if not metadata.get("save"):
+            data = dict(data, save_allowed=False)
+        return cls(
+            data["name"],
+            tuple(text.lower() for text in data.get("match", [data["name"]])),
+            metadata,
+            MeshMatcher.compile(metadata["info"]),
+            re.compile(metadata["probe"][1]) if "probe" in metadata else None,
+            data.get("save_allowed", True),
+            data.get("probe_required", False),
+        )
+
+
+def firmware_name(line):
+    # text after FIRMWARE_NAME up to the next KEY: of the M115 report
+    idx = line.find("FIRMWARE_NAME:") + len("FIRMWARE_NAME:")
+    following = FIELD_REGX.search(line, idx)
+    end = following.start() if following is not None else len(line)
+    return line[idx:end].strip()
+
+
+def firmware_uuid(line):
+    idx = line.find("UUID:")
+    if idx == -1:
+        return None
+    return line[idx + 5 :].split(None, 1)[0]
+
+
+def parse_cap(line):
+    match = CAP_REGX.match(line.strip())
+    if match is None:
+        return None
+    return match.group(1), match.group(2) == "1"
+
+
+class FirmwareRegistry:
+    def __init__(self, folder=None, logger=None):
+        self.folder = folder
+        self.logger = logger or logging.getLogger(__name__)
+        self.profiles = {}
+        self.order = []
+
+    def load(self):
+        raw = {data["name"]: data for data in BUILTIN}
+        order = [data["name"] for data in BUILTIN]
+        custom = []
+        if self.folder is not None:
+            for path in sorted(glob.glob(os.path.join(self.folder, "*.json"))):
+                try:
+                    with open(path) as f:
+                        data = json.load(f)
+                    for profile in data if isinstance(data, list) else [data]:
+                        raw[profile["name"]] = profile
+                        custom.append(profile["name"])
+                except (OSError, ValueError, KeyError, TypeError):
+                    self.logger.exception(
+                        f"@firmware > Error loading profile {path}"
+                    )
+        profiles = {}
+        for name in raw:
+            try:
+                profiles[name] = FirmwareProfile.compile(
+                    self._resolve(raw, name)
+                )
+            except (KeyError, ValueError, TypeError, IndexError, re.error):
+                self.logger.exception(f"@firmware > Invalid profile {name}")
+        self.profiles = profiles
+        # custom profiles are checked before the builtin ones
+        self.order = [
+            name
+            for name in dict.fromkeys(custom + order)
+            if name in self.profiles
+        ]
+        return self
+
+    def _resolve(self, raw, name, seen=()):
+        data = raw[name]
+        base = data.get("extends")
+        if base is None:
+            return dict(data)
+        if base in seen or base == name:
+            raise ValueError(f"{name}: circular extends")
+        resolved = self._resolve(raw, base, seen + (name,))
+        for key in ("match", "save_allowed", "probe_required"):
+            resolved.pop(key, None)
+        resolved.update(data)
+        return resolved
+
+    def get(self, name):
+        return self.profiles.get(name)
+
+    def detect(self, line):
+        name = firmware_name(line).lower()
+        for profile_name in self.order:
+            profile = self.profiles[profile_name]
+            if any(text in name for text in profile.match):
+                return profile
+        return None
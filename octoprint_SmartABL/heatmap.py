@@ -0,0 +1,181 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from .mesh import interpolate
+
+# diverging scale, blue below zero and red above
+COLORS = np.array(
+    [
+        (49, 54, 149),
+        (116, 173, 209),
+        (255, 255, 255),
+        (244, 109, 67),
+        (165, 0, 38),
+    ],
+    np.float64,
+)
+MISSING = np.array((128, 128, 128), np.uint8)
+
+
+def resample(mesh, width, height):
+    rows, cols = mesh.z.shape
+    ys, xs = np.mgrid[
+        0 : rows - 1 : height * 1j,
+        0 : cols - 1 : width * 1j,
+    ]
+    # grid coordinates, the bed ones don't matter here
+    return interpolate(mesh, (0, 0, cols - 1, rows - 1), xs, ys)
+
+
+def colormap(values, limit):
+    scale = np.clip((values / (limit or 1.0) + 1) / 2, 0, 1)
+    scale = np.nan_to_num(scale) * (len(COLORS) - 1)
+    idx = np.minimum(scale.astype(int), len(COLORS) - 2)
+    frac = (scale - idx)[..., None]
+    rgb = COLORS[idx] * (1 - frac) + COLORS[idx + 1] * frac
+    rgb = rgb.round().astype(np.uint8)
+    rgb[np.isnan(values)] = MISSING
+    return rgb
+
+
+def png(rgb):
+    height, width, _ = rgb.shape
+    # filter byte (none) in front of each row
+    raw = np.hstack(
+        (np.zeros((height, 1), np.uint8), rgb.reshape(height, -1))
+    ).tobytes()
+
+    def chunk(tag, data):
+        crc = zlib.crc32(tag + data) & 0xFFFFFFFF
+        return (
+            struct.pack(">I", len(data)) + tag + data + struct.pack(">I", crc)
+        )
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+def grid(z, decimals=3):
+    return [
+        [
+            None if np.isnan(value) else round(float(value), decimals)
+            for value in row
+        ]
+        for row in z
+    ]
+
+
+class HeatmapCache:
+    def __init__(self, size=96, grid_max=25, limit=8):
+        self.size = size  # longest side of the images
+        self.grid_max = grid_max  # points per side in the json
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    @staticmethod
+    def delta(mesh, previous):
+        if (
+            previous is None
+            or previous.z.shape != mesh.z.shape
+            or previous.bounds != mesh.bounds
+        ):
+            return None
+        return mesh.z - previous.z
+
+    def get(self, kind, mesh, previous):
+        key = (kind, mesh.id, previous.id if previous is not None else None)
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+        # rendered outside of the lock, a race only renders it twice
+        value = getattr(self, f"_{kind}")(mesh, previous)
+        with self.lock:
+            self.items[key] = value
+            while len(self.items) > self.limit:
+                self.items.popitem(last=False)
+        return value
+
+    def warm(self, mesh, previous):
+        for kind in ("json", "png", "delta"):
+            self.get(kind, mesh, previous)
+
+    def _json(self, mesh, previous):
+        z = self._decimate(mesh)
+        delta = self.delta(mesh, previous)
+        if delta is not None:
+            delta = self._decimate(mesh._replace(z=delta))
+        body = dict(
+            id=mesh.id,
+            timestamp=mesh.timestamp,
+            bedtemp=mesh.bedtemp,
+            bounds=mesh.bounds,
+            shape=mesh.z.shape,
+            min=self._stat(np.nanmin, mesh.z),
+            max=self._stat(np.nanmax, mesh.z),
+            z=grid(z),
+            previous=previous.id if previous is not None else None,
+            delta=grid(delta) if delta is not None else None,
+            delta_max=(
+                self._stat(np.nanmax, np.abs(delta))
+                if delta is not None
+                else None
+            ),
+        )
+        return json.dumps(body, sort_keys=True)
+
+    def _png(self, mesh, previous):
+        if np.isnan(mesh.z).all():
+            return None
+        return self._render(mesh, mesh.z - np.nanmean(mesh.z))
+
+    def _delta(self, mesh, previous):
+        delta = self.delta(mesh, previous)
+        if delta is None:
+            return None
+        return self._render(mesh, delta)
+
+    def _render(self, mesh, values):
+        if min(values.shape) < 2 or np.isnan(values).all():
+            return None
+        width, height = self._dimensions(mesh)
+        z = resample(mesh._replace(z=values), width, height)
+        limit = float(np.nanmax(np.abs(values)))
+        # rows go from the front to the back of the bed, images top down
+        return png(colormap(np.flipud(z), limit))
+
+    def _dimensions(self, mesh):
+        if mesh.bounds is None:
+            return self.size, self.size
+        min_x, min_y, max_x, max_y = mesh.bounds
+        ratio = (max_y - min_y) / (max_x - min_x)
+        if ratio > 1:
+            return max(int(self.size / ratio), 2), self.size
+        return self.size, max(int(self.size * ratio), 2)
+
+    def _decimate(self, mesh):
+        rows, cols = mesh.z.shape
+        if max(rows, cols) <= self.grid_max or min(rows, cols) < 2:
+            return mesh.z
+        return resample(
+            mesh, min(cols, self.grid_max), min(rows, self.grid_max)
+        )
+
+    @staticmethod
+    def _stat(func, values):
+        if np.isnan(values).all():
+            return None
+        return round(float(func(values)), 3)
@@ -0,0 +1,158 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import sqlite3
+import threading
+import time
+
+COLUMNS = (
+    "time",
+    "outcome",
+    "reason",
+    "firmware",
+    "bedtemp",
+    "hetemp",
+    "file",
+    "prints",
+    "days",
+    "duration",
+    "value",
+)
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS decisions ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "time REAL NOT NULL, "
+    "outcome TEXT NOT NULL, "
+    "reason TEXT, "
+    "firmware TEXT, "
+    "bedtemp REAL, "
+    "hetemp REAL, "
+    "file TEXT, "
+    "prints INTEGER, "
+    "days INTEGER, "
+    "duration REAL, "
+    "value REAL)",
+    "CREATE INDEX IF NOT EXISTS decisions_time ON decisions (time)",
+    "CREATE INDEX IF NOT EXISTS decisions_outcome "
+    "ON decisions (outcome, time)",
+)
+INSERT = (
+    f"INSERT INTO decisions ({', '.join(COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(COLUMNS))})"
+)
+
+
+class DecisionHistory:
+    def __init__(self, path, batch=50, delay=2.0, logger=None):
+        self.path = path
+        self.batch = batch
+        self.delay = delay
+        self.logger = logger or logging.getLogger(__name__)
+        self.pending = []
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        conn = self._connect()
+        try:
+            # readers (the API) don't block the writer thread
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+        finally:
+            conn.close()
+        if self.thread is None:
+            self.stopped = False
+            self.thread = threading.Thread(
+                target=self._run, name="SmartABL history", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self, timeout=10):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def record(self, outcome, **fields):
+        fields.update(outcome=outcome)
+        fields.setdefault("time", time.time())
+        row = tuple(fields.get(column) for column in COLUMNS)
+        with self.cond:
+            self.pending.append(row)
+            if len(self.pending) >= self.batch:
+                self.cond.notify()
+
+    def query(
+        self, limit=50, before=None, outcome=None, since=None, until=None
+    ):
+        where = []
+        args = []
+        if before is not None:
+            where.append("id < ?")
+            args.append(int(before))
+        if outcome:
+            where.append("outcome = ?")
+            args.append(outcome)
+        if since is not None:
+            where.append("time >= ?")
+            args.append(float(since))
+        if until is not None:
+            where.append("time < ?")
+            args.append(float(until))
+        sql = f"SELECT id, {', '.join(COLUMNS)} FROM decisions"
+        if where:
+            sql += f" WHERE {' AND '.join(where)}"
+        # keyset pagination, stable while new rows are appended
+        sql += " ORDER BY id DESC LIMIT ?"
+        args.append(max(1, min(int(limit), 1000)))
+        conn = self._connect()
+        try:
+            rows = [
+                dict(zip(("id",) + COLUMNS, row))
+                for row in conn.execute(sql, args)
+            ]
+        finally:
+            conn.close()
+        before = rows[-1]["id"] if len(rows) == args[-1] else None
+        return dict(decisions=rows, before=before)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _take(self):
+        with self.cond:
+            pending, self.pending = self.pending, []
+        return pending
+
+    def _write(self, conn, rows):
+        if not rows:
+            return
+        try:
+            with conn:
+                conn.executemany(INSERT, rows)
+        except sqlite3.Error:
+            self.logger.exception(
+                f"@history > Error writing {len(rows)} decisions"
+            )
+
+    def _run(self):
+        conn = self._connect()
+        try:
+            while True:
+                with self.cond:
+                    if not self.stopped and len(self.pending) < self.batch:
+                        self.cond.wait(self.delay)
+                    stopped = self.stopped
+                self._write(conn, self._take())
+                if stopped:
+                    return
+        finally:
+            conn.close()
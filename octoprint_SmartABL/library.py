@@ -0,0 +1,64 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import time
+
+
+class MeshLibrary:
+    def __init__(self, entries, slots=4):
+        # entries is the dict stored in state.json, updated in place
+        self.entries = entries
+        self.slots = slots
+
+    @staticmethod
+    def key(bedtemp, band, sheet=""):
+        band = max(int(band or 1), 1)
+        return f"{int(round(float(bedtemp) / band)) * band}|{sheet or ''}"
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def store(self, key, today):
+        entry = self.entries.get(key)
+        if entry is None:
+            used = {ent["slot"] for ent in self.entries.values()}
+            free = [slot for slot in range(self.slots) if slot not in used]
+            if free:
+                slot = free[0]
+            else:
+                # reuse the slot of the least recently used entry
+                lru = min(self.entries, key=lambda k: self.entries[k]["used"])
+                slot = self.entries.pop(lru)["slot"]
+            entry = self.entries[key] = dict(slot=slot)
+        # slot_saved once the firmware got the slot save commands,
+        # persisted once the slot survives a firmware restart
+        entry.update(
+            prints=0,
+            last_mesh=today,
+            mesh_id=None,
+            slot_saved=False,
+            persisted=False,
+            used=time.time(),
+        )
+        return entry
+
+    def persist(self):
+        for entry in self.entries.values():
+            if entry.get("slot_saved"):
+                entry["persisted"] = True
+
+    def drop_volatile(self):
+        dropped = [
+            key
+            for key, entry in self.entries.items()
+            if entry.get("slot_saved") and not entry.get("persisted", True)
+        ]
+        for key in dropped:
+            del self.entries[key]
+        return dropped
+
+    def touch(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry["used"] = time.time()
+        return entry
@@ -0,0 +1,47 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import collections
+import logging
+import logging.handlers
+import queue
+
+
+class Lazy:
+    __slots__ = ("func",)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __str__(self):
+        return str(self.func())
+
+
+class RingBufferHandler(logging.Handler):
+    def __init__(self, capacity=500):
+        super().__init__()
+        self.records = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(
+            dict(
+                time=record.created,
+                level=record.levelname,
+                tag=getattr(record, "tag", None),
+                message=record.getMessage(),
+            )
+        )
+
+    def dump(self):
+        with self.lock:
+            return list(self.records)
+
+
+def queue_logging(logger, *handlers):
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    listener.start()
+    return listener
@@ -0,0 +1,71 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+from collections import deque
+
+IDLE = "IDLE"
+PREFETCHING = "PREFETCHING"  # mesh queried ahead of the trigger, no hold
+QUERYING = "QUERYING"  # job held, waiting for the mesh report
+DECIDING = "DECIDING"  # job held, @SMARTABLDECIDE queued
+PROBING = "PROBING"  # ABL or drift check points sent
+SAVING = "SAVING"  # ABL done, capturing the new mesh
+TRANSITIONS = {
+    # DECIDING straight away if the prefetched report is fresh
+    IDLE: frozenset((PREFETCHING, QUERYING, DECIDING)),
+    PREFETCHING: frozenset((IDLE, QUERYING)),
+    QUERYING: frozenset((DECIDING, IDLE)),
+    DECIDING: frozenset((PROBING, IDLE)),
+    # a drift check over the threshold is followed by a full ABL
+    PROBING: frozenset((PROBING, SAVING, IDLE)),
+    SAVING: frozenset((IDLE,)),
+}
+
+
+class StateMachine:
+    def __init__(self, history=100):
+        # reentrant: transitions happen inside the hooks holding it
+        self.lock = threading.RLock()
+        self.state = IDLE
+        self.drift = False  # PROBING a few points, not a full ABL
+        self.since = time.monotonic()
+        self.log = deque(maxlen=history)
+
+    def transition(self, target, event, drift=False):
+        with self.lock:
+            accepted = target in TRANSITIONS[self.state]
+            self.log.append((time.time(), self.state, target, event, accepted))
+            if accepted:
+                self.state = target
+                self.drift = drift
+                self.since = time.monotonic()
+            return accepted
+
+    def reset(self, event):
+        with self.lock:
+            if self.state == IDLE:
+                return False
+            self.log.append((time.time(), self.state, IDLE, event, True))
+            self.state = IDLE
+            self.drift = False
+            self.since = time.monotonic()
+            return True
+
+    def snapshot(self):
+        with self.lock:
+            return dict(
+                state=self.state,
+                drift=self.drift,
+                seconds=time.monotonic() - self.since,
+                transitions=[
+                    dict(
+                        time=entry[0],
+                        source=entry[1],
+                        target=entry[2],
+                        event=entry[3],
+                        accepted=entry[4],
+                    )
+                    for entry in self.log
+                ],
+            )
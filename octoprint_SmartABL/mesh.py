@@ -0,0 +1,348 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import io
+import os
+import re
+import warnings
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from .storage import atomic_write
+
+
+class Mesh(NamedTuple):
+    # rows follow Y from front to back, columns X from left to right
+    z: np.ndarray
+    # min_x, min_y, max_x, max_y when the report includes them
+    bounds: Optional[Tuple[float, float, float, float]]
+    timestamp: float
+    bedtemp: float
+    # printer usage (prints, print hours, thermal cycles) when probed,
+    # None if the mesh was only reported
+    usage: Optional[Tuple[float, float, float]] = None
+
+    @property
+    def id(self):
+        return int(self.timestamp * 1000)
+
+    def same_grid(self, other):
+        return (
+            other is not None
+            and self.z.shape == other.z.shape
+            and np.array_equal(self.z, other.z, equal_nan=True)
+        )
+
+
+def interpolate(mesh, bounds, xs, ys):
+    # bilinear interpolation of the grid at bed coordinates
+    rows, cols = mesh.z.shape
+    min_x, min_y, max_x, max_y = bounds
+    gx = np.clip(
+        (np.asarray(xs, float) - min_x) / (max_x - min_x) * (cols - 1),
+        0,
+        cols - 1,
+    )
+    gy = np.clip(
+        (np.asarray(ys, float) - min_y) / (max_y - min_y) * (rows - 1),
+        0,
+        rows - 1,
+    )
+    x0 = np.minimum(gx.astype(int), max(cols - 2, 0))
+    y0 = np.minimum(gy.astype(int), max(rows - 2, 0))
+    x1 = np.minimum(x0 + 1, cols - 1)
+    y1 = np.minimum(y0 + 1, rows - 1)
+    tx = gx - x0
+    ty = gy - y0
+    z = mesh.z
+    return (z[y0, x0] * (1 - tx) + z[y0, x1] * tx) * (1 - ty) + (
+        z[y1, x0] * (1 - tx) + z[y1, x1] * tx
+    ) * ty
+
+
+def drift(mesh, bounds, probes):
+    # max deviation of the probed points against the mesh, ignoring
+    # the offset common to all of them (z offset, probe trigger height)
+    xs, ys, zs = np.asarray(probes, float).T
+    delta = zs - interpolate(mesh, bounds, xs, ys)
+    delta = delta[~np.isnan(delta)]
+    if not delta.size:
+        return None
+    return float(np.abs(delta - delta.mean()).max())
+
+
+class MeshQuality(NamedTuple):
+    range: float  # highest minus lowest point
+    residual: float  # max distance to the best fit (tilt) plane
+    outlier: float  # max distance to the median of the neighbours
+    missing: int  # points not probed
+    # not a grid or the probed points don't span a plane, the rest of
+    # the values mean nothing
+    degenerate: bool = False
+
+    def issues(self, limits):
+        if self.degenerate:
+            return ["degenerate"]
+        # checks without limit (None) are skipped
+        return [
+            name
+            for name, limit in limits.items()
+            if limit is not None and getattr(self, name) > limit
+        ]
+
+
+def quality(z):
+    z = np.asarray(z, float)
+    valid = ~np.isnan(z)
+    missing = int(z.size - np.count_nonzero(valid))
+    if z.ndim != 2 or min(z.shape) < 2 or np.count_nonzero(valid) < 3:
+        return MeshQuality(0.0, 0.0, 0.0, missing, True)
+    ys, xs = np.nonzero(valid)
+    coords = np.column_stack((xs, ys, np.ones(len(xs))))
+    plane, _, rank, _ = np.linalg.lstsq(coords, z[valid], rcond=None)
+    if rank < 3:
+        # collinear points, no tilt can be fitted
+        return MeshQuality(0.0, 0.0, 0.0, missing, True)
+    # outliers are looked for without the tilt, which would make the
+    # border points look different from their neighbours
+    flat = np.full(z.shape, np.nan)
+    flat[valid] = z[valid] - coords @ plane
+    rows, cols = z.shape
+    padded = np.pad(flat, 1, constant_values=np.nan)
+    neighbours = np.stack(
+        [
+            padded[1 + dy : 1 + dy + rows, 1 + dx : 1 + dx + cols]
+            for dy in (-1, 0, 1)
+            for dx in (-1, 0, 1)
+            if dy or dx
+        ]
+    )
+    with warnings.catch_warnings():
+        # points without probed neighbours
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median = np.nanmedian(neighbours, axis=0)
+    outlier = np.abs(flat - median)
+    outlier = outlier[~np.isnan(outlier)]
+    return MeshQuality(
+        float(np.ptp(z[valid])),
+        float(np.abs(flat[valid]).max()),
+        float(outlier.max()) if outlier.size else 0.0,
+        missing,
+    )
+
+
+class MeshParser:
+    # (x,y) pairs printed around the grid by some reports, e.g. marlin UBL
+    corner_regx = re.compile(r"\(\s*([-+\d.]+)\s*,\s*([-+\d.]+)\s*\)")
+    # values of the "9 | +0.148 [+0.050]" rows of marlin UBL/buddy, the
+    # brackets mark the nozzle position
+    cell_regx = re.compile(r"[^\s\[\]]+")
+    # " +0.148 " columns, left blank if the point wasn't probed
+    cell_width = 8
+    # points not probed: "=====" in marlin bilinear, "." in UBL
+    unprobed = frozenset("=.")
+
+    def __init__(self, reverse=False):
+        self.reverse = reverse
+        self.rows = []
+        self.corners = []
+        self.columns = None
+        self.labels = []
+        self.done = False
+        self.error = None
+
+    def feed(self, line):
+        line = line.strip()
+        if line.startswith("//"):  # klipper responses
+            line = line[2:].strip()
+        if line.startswith("ok"):
+            self.done = True
+        elif not line:
+            pass
+        elif "(" in line:
+            self.corners.extend(
+                (float(x), float(y)) for x, y in self.corner_regx.findall(line)
+            )
+        elif "|" in line:
+            label, _, cells = line.partition("|")
+            if not label.strip():
+                pass  # "   |" between the rows
+            elif not self._index(label.strip()):
+                self.done = bool(self.rows)
+            else:
+                values = self._cells(cells)
+                if values is None:
+                    self._unreadable(label.strip())
+                elif values:
+                    self.labels.append(int(label))
+                    self._row(values)
+        else:
+            tokens = line.split()
+            values = self._values(tokens)
+            if values is None:
+                if self._index(tokens[0]):
+                    self._unreadable(tokens[0])
+                else:
+                    # first line that isn't part of the grid
+                    self.done = bool(self.rows)
+            elif all(self._index(tk) for tk in tokens):
+                self.columns = len(tokens)  # column indexes
+            else:
+                if self._index(tokens[0]):
+                    self.labels.append(int(tokens[0]))
+                    values = values[1:]  # row index
+                self._row(values)
+        return self.done
+
+    def _unreadable(self, label):
+        self.error = f"Unreadable row {label}"
+        self.done = True
+
+    def _row(self, values):
+        if self.rows and len(values) != len(self.rows[0]):
+            self.error = "Inconsistent row length"
+            self.done = True
+        else:
+            self.rows.append(values)
+
+    def _cells(self, cells):
+        columns = {}
+        for match in self.cell_regx.finditer(cells):
+            values = self._values([match.group()])
+            if values is None:
+                return None
+            middle = (match.start() + match.end()) // 2
+            columns[middle // self.cell_width] = values[0]
+        count = max(self.columns or 0, max(columns, default=-1) + 1)
+        return [columns.get(col, np.nan) for col in range(count)]
+
+    def mesh(self, timestamp, bedtemp, usage=None):
+        if self.error is None and self.rows:
+            self.error = self._check()
+        if self.error is not None or not self.rows:
+            return None
+        z = np.array(self.rows, dtype=np.float32)
+        if self.reverse:
+            z = z[::-1]
+        return Mesh(
+            np.ascontiguousarray(z),
+            self._bounds(z.shape),
+            timestamp,
+            bedtemp,
+            usage,
+        )
+
+    def _check(self):
+        rows, cols = len(self.rows), len(self.rows[0])
+        if self.columns is not None and cols != self.columns:
+            return f"{cols} columns, the report has {self.columns}"
+        if self.labels and sorted(self.labels) != list(range(rows)):
+            return f"Rows {self.labels}, expected 0 to {rows - 1}"
+        return None
+
+    def _bounds(self, shape):
+        rows, cols = shape
+        indexes = {(0, 0), (0, rows - 1), (cols - 1, 0), (cols - 1, rows - 1)}
+        coords = [pair for pair in self.corners if pair not in indexes]
+        if not coords:
+            return None
+        xs, ys = zip(*coords)
+        return (min(xs), min(ys), max(xs), max(ys))
+
+    @staticmethod
+    def _index(token):
+        return token.isdigit()
+
+    @classmethod
+    def _values(cls, tokens):
+        values = []
+        for token in tokens:
+            token = token.strip("[]")
+            if set(token) <= cls.unprobed:
+                values.append(np.nan)
+                continue
+            try:
+                values.append(float(token))
+            except ValueError:
+                return None
+        return values
+
+
+class MeshHistory:
+    def __init__(self, path, limit=100):
+        self.path = path
+        self.limit = limit
+        self.meshes = []
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with np.load(self.path) as data:
+            offsets = np.cumsum(np.prod(data["shapes"], axis=1))[:-1]
+            grids = np.split(data["z"], offsets)
+            usages = (
+                data["usage"]
+                if "usage" in data.files
+                else np.full((len(data["shapes"]), 3), np.nan)
+            )
+            self.meshes = [
+                Mesh(
+                    grid.reshape(shape),
+                    None if np.isnan(bounds).any() else tuple(bounds.tolist()),
+                    float(timestamp),
+                    float(bedtemp),
+                    None if np.isnan(usage).any() else tuple(usage.tolist()),
+                )
+                for grid, shape, bounds, timestamp, bedtemp, usage in zip(
+                    grids,
+                    data["shapes"],
+                    data["bounds"],
+                    data["timestamps"],
+                    data["bedtemps"],
+                    usages,
+                )
+            ]
+
+    @property
+    def last(self):
+        return self.meshes[-1] if self.meshes else None
+
+    def append(self, mesh):
+        if mesh.same_grid(self.last):
+            return False
+        self.meshes.append(mesh)
+        del self.meshes[: -self.limit]
+        return True
+
+    def get(self, mesh_id):
+        for mesh in reversed(self.meshes):
+            if mesh.id == mesh_id:
+                return mesh
+        return None
+
+    def snapshot(self):
+        meshes = self.meshes
+        return dict(
+            timestamps=np.array([m.timestamp for m in meshes], np.float64),
+            bedtemps=np.array([m.bedtemp for m in meshes], np.float32),
+            shapes=np.array([m.z.shape for m in meshes], np.int32).reshape(
+                -1, 2
+            ),
+            bounds=np.array(
+                [m.bounds or (np.nan,) * 4 for m in meshes], np.float64
+            ).reshape(-1, 4),
+            usage=np.array(
+                [m.usage or (np.nan,) * 3 for m in meshes], np.float64
+            ).reshape(-1, 3),
+            z=(
+                np.concatenate([m.z.ravel() for m in meshes])
+                if meshes
+                else np.empty(0, np.float32)
+            ),
+        )
+
+    def save(self, snapshot):
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **snapshot)
+        atomic_write(self.path, buffer.getvalue(), "wb")
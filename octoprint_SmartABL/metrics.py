@@ -0,0 +1,109 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import bisect
+import threading
+
+
+class Histogram:
+    # seconds, from a mesh query up to a full ABL on a big bed
+    buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30, 60, 120, 300, 600)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def snapshot(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return dict(count=self.count, sum=self.sum, buckets=buckets)
+
+
+class Metrics:
+    def __init__(self, prefix="smartabl"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def mean(self, name):
+        histogram = self.histograms.get(name)
+        return histogram.mean if histogram is not None else 0.0
+
+    def snapshot(self):
+        with self.lock:
+            counters = {}
+            for (name, labels), value in self.counters.items():
+                counters.setdefault(name, []).append(
+                    dict(labels=dict(labels), value=value)
+                )
+            return dict(
+                counters=counters,
+                histograms={
+                    name: histogram.snapshot()
+                    for name, histogram in self.histograms.items()
+                },
+            )
+
+    def prometheus(self, gauges=None):
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = f"{self.prefix}_{name}"
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric}{self._labels(labels)} {value}")
+            for name, histogram in sorted(self.histograms.items()):
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, count in zip(
+                    histogram.buckets + ("+Inf",), histogram.counts
+                ):
+                    cumulative += count
+                    lines.append(
+                        f'{metric}_bucket{{le="{bound}"}} {cumulative}'
+                    )
+                lines.append(f"{metric}_sum {histogram.sum}")
+                lines.append(f"{metric}_count {histogram.count}")
+        for name, value in sorted((gauges or {}).items()):
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        pairs = ",".join(f'{key}="{value}"' for key, value in labels)
+        return f"{{{pairs}}}"
@@ -0,0 +1,95 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+# mesh deltas are fitted against the usage between both probes
+FEATURES = ("days", "prints", "hours", "cycles")
+
+
+class DriftModel(NamedTuple):
+    weights: np.ndarray  # mm per unit of each feature, never negative
+    rmse: float
+    samples: int
+
+    def predict(self, features):
+        # pessimistic: the fit plus its typical error
+        return float(np.dot(self.weights, features) + self.rmse)
+
+
+def usage_features(reference, now, usage):
+    # reference is a probed mesh, usage the current (prints, hours, cycles)
+    return np.concatenate(
+        (
+            [(now - reference.timestamp) / 86400],
+            np.asarray(usage, float) - np.asarray(reference.usage, float),
+        )
+    )
+
+
+def reference(meshes, bedtemp, tolerance):
+    # last probed mesh at a similar bed temperature
+    for mesh in reversed(meshes):
+        if mesh.usage is not None and abs(mesh.bedtemp - bedtemp) <= tolerance:
+            return mesh
+    return None
+
+
+def pairs(meshes, tolerance):
+    # consecutive probes of the same grid and similar bed temperature
+    previous = {}
+    found = []
+    for mesh in meshes:
+        if mesh.usage is None:
+            continue
+        for key, other in previous.items():
+            if (
+                key[0] == mesh.z.shape
+                and abs(other.bedtemp - mesh.bedtemp) <= tolerance
+            ):
+                found.append((other, mesh))
+                del previous[key]
+                break
+        previous[(mesh.z.shape, mesh.bedtemp)] = mesh
+    return found
+
+
+def deltas(found):
+    # max change of the surface between probes, ignoring the common
+    # offset; grouped by shape so each group is a single array op
+    result = np.empty(len(found))
+    shapes = {}
+    for idx, pair in enumerate(found):
+        shapes.setdefault(pair[1].z.shape, []).append(idx)
+    for idxs in shapes.values():
+        new = np.stack([found[i][1].z for i in idxs]).astype(float)
+        old = np.stack([found[i][0].z for i in idxs]).astype(float)
+        flat = (new - old).reshape(len(idxs), -1)
+        flat = flat - np.nanmean(flat, axis=1, keepdims=True)
+        result[idxs] = np.nanmax(np.abs(flat), axis=1)
+    return result
+
+
+def fit(meshes, tolerance=5, min_samples=4) -> Optional[DriftModel]:
+    found = pairs(meshes, tolerance)
+    if len(found) < min_samples:
+        return None
+    features = np.array(
+        [usage_features(old, new.timestamp, new.usage) for old, new in found]
+    )
+    target = deltas(found)
+    valid = ~np.isnan(target) & ~np.isnan(features).any(axis=1)
+    features, target = features[valid], target[valid]
+    if len(target) < min_samples:
+        return None
+    weights = np.linalg.lstsq(features, target, rcond=None)[0]
+    # drift can't decrease with usage: drop negative terms and refit
+    keep = weights > 0
+    weights = np.zeros_like(weights)
+    if keep.any():
+        refit = np.linalg.lstsq(features[:, keep], target, rcond=None)[0]
+        weights[keep] = refit.clip(min=0)
+    rmse = float(np.sqrt(np.mean((features @ weights - target) ** 2)))
+    return DriftModel(weights, rmse, len(target))
@@ -0,0 +1,41 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from octoprint.filemanager.util import LineProcessorStream
+
+from .prescan import MARKER, MOVES, header
+
+
+class MarkerStream(LineProcessorStream):
+    def __init__(self, input_stream, matcher):
+        super().__init__(input_stream)
+        self.matcher = matcher
+        self.header = f"{header(matcher)}\n".encode()
+
+    def process_line(self, line):
+        if self.header is not None:
+            # the settings used to mark the file, read when it's printed
+            first, self.header = self.header, None
+            return first + self._mark(line)
+        return self._mark(line)
+
+    def _mark(self, line):
+        if line[:3] in MOVES or line[:1] == b";":
+            return line
+        cmd = line.split(b";", 1)[0].strip().decode("ascii", "ignore")
+        if not cmd:
+            return line
+        gcode = cmd.split(None, 1)[0].upper()
+        matcher = self.matcher
+        if (
+            gcode in matcher.trigger
+            or cmd in matcher.trigger
+            or (
+                matcher.cmd_ignore
+                and (gcode in matcher.ignore or cmd in matcher.ignore)
+            )
+        ):
+            # kept, not dropped: files marked with other settings are
+            # checked again
+            return f"{MARKER} {cmd}\n".encode()
+        return line
@@ -0,0 +1,181 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import os
+import re
+import threading
+
+from .storage import atomic_write, load_json
+from .temperature import parse_temp, parse_tool
+
+# extrusion/travel moves are the bulk of any file, only read for the
+# footprint of the print
+MOVES = (b"G0 ", b"G1 ", b"G2 ", b"G3 ")
+EXTRUDING = (b"G1 ", b"G2 ", b"G3 ")
+AXIS_REGX = re.compile(rb"([XYE])\s*([-+]?\d*\.?\d+)")
+# bumped when the entries change, old ones are scanned again
+VERSION = 4
+# lines rewritten by the upload preprocessor, the original line follows
+MARKER = "@SMARTABLMARK"
+HEADER = ";SmartABL preprocessed "
+
+
+def fingerprint(matcher):
+    # everything that changes the marked lines
+    return f"v{VERSION};{int(matcher.cmd_ignore)};" + ";".join(
+        ",".join(sorted(codes))
+        for codes in (matcher.trigger, matcher.ignore, matcher.custom)
+    )
+
+
+def header(matcher):
+    return f"{HEADER}{fingerprint(matcher)}"
+
+
+def scan(path, matcher, temp_gcodes):
+    triggers = []
+    temps = {}
+    ignored = set()
+    custom = set()
+    lines = 0
+    offset = 0
+    tool = 0
+    footprint = Footprint()
+    with open(path, "rb") as f:
+        for raw in f:
+            lines += 1
+            start = offset
+            offset += len(raw)
+            if raw[:3] in MOVES:
+                footprint.move(raw)
+                continue
+            if raw[:1] == b";":
+                continue
+            cmd = raw.split(b";", 1)[0].strip().decode("ascii", "ignore")
+            if cmd.startswith(MARKER):
+                cmd = cmd[len(MARKER) :].strip()
+            if not cmd:
+                continue
+            gcode = cmd.split(None, 1)[0].upper()
+            if gcode in Footprint.MODES:
+                footprint.mode(gcode, cmd)
+            if gcode in matcher.trigger or cmd in matcher.trigger:
+                triggers.append([start, lines, cmd])
+            if gcode in matcher.ignore or cmd in matcher.ignore:
+                ignored.add(cmd)
+            if gcode in matcher.custom or cmd in matcher.custom:
+                custom.add(cmd)
+            if gcode[0] == "T":
+                selected = parse_tool(cmd)
+                if selected is not None:
+                    tool = selected
+            elif gcode in temp_gcodes:
+                temp = parse_temp(cmd, tool)
+                if temp is not None and temp.heater not in temps:
+                    temps[temp.heater] = temp.target
+    return dict(
+        lines=lines,
+        size=offset,
+        triggers=triggers,
+        temps=temps,
+        ignored=sorted(ignored),
+        custom=sorted(custom),
+        footprint=footprint.bounds,
+    )
+
+
+class Footprint:
+    # gcodes changing how the coordinates of the moves are read
+    MODES = frozenset(("G90", "G91", "G92", "M82", "M83"))
+
+    def __init__(self):
+        self.x = self.y = self.e = 0.0
+        self.relative = False
+        self.relative_e = False
+        self.box = None
+
+    def mode(self, gcode, cmd):
+        if gcode == "G90":
+            self.relative = self.relative_e = False
+        elif gcode == "G91":
+            self.relative = self.relative_e = True
+        elif gcode == "M82":
+            self.relative_e = False
+        elif gcode == "M83":
+            self.relative_e = True
+        else:
+            for axis, value in AXIS_REGX.findall(cmd.upper().encode()):
+                if axis == b"E":
+                    self.e = float(value)
+                elif axis == b"X":
+                    self.x = float(value)
+                else:
+                    self.y = float(value)
+
+    def move(self, raw):
+        x, y, e = self.x, self.y, None
+        for axis, value in AXIS_REGX.findall(raw.split(b";", 1)[0]):
+            value = float(value)
+            if axis == b"X":
+                x = x + value if self.relative else value
+            elif axis == b"Y":
+                y = y + value if self.relative else value
+            else:
+                e = value
+        extruding = False
+        if e is not None and raw[:3] in EXTRUDING:
+            extruding = e > 0 if self.relative_e else e > self.e
+            if not self.relative_e:
+                self.e = e
+        if extruding:
+            # the segment starts where the previous move ended
+            box = self.box or (self.x, self.y, self.x, self.y)
+            self.box = (
+                min(box[0], self.x, x),
+                min(box[1], self.y, y),
+                max(box[2], self.x, x),
+                max(box[3], self.y, y),
+            )
+        self.x, self.y = x, y
+
+    @property
+    def bounds(self):
+        return list(self.box) if self.box is not None else None
+
+
+class PrescanIndex:
+    def __init__(self, path, limit=200, logger=None):
+        self.path = path
+        self.limit = limit
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def load(self):
+        self.entries = load_json(self.path, self.logger) or {}
+
+    @staticmethod
+    def key(path, matcher):
+        stat = os.stat(path)
+        return (
+            f"{path}|{stat.st_size}|{stat.st_mtime_ns}|{fingerprint(matcher)}"
+        )
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key, entry):
+        with self.lock:
+            # drop entries of older versions of the same file
+            path = key.split("|", 1)[0]
+            for old in [k for k in self.entries if k.split("|", 1)[0] == path]:
+                del self.entries[old]
+            self.entries[key] = entry
+            for old in list(self.entries)[: -self.limit]:
+                del self.entries[old]
+            return json.dumps(self.entries)
+
+    def save(self, data):
+        atomic_write(self.path, data)
@@ -0,0 +1,78 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class Timer:
+    __slots__ = ("deadline", "func", "args", "cancelled")
+
+    def __init__(self, deadline, func, args):
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        if self.thread is None:
+            self.stopped = False
+            self.thread = threading.Thread(
+                target=self._run, name="SmartABL scheduler", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self, timeout=5):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def call_later(self, delay, func, *args):
+        timer = Timer(time.monotonic() + delay, func, args)
+        with self.cond:
+            heapq.heappush(
+                self.heap, (timer.deadline, next(self.counter), timer)
+            )
+            self.cond.notify()
+        return timer
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.stopped:
+                    # drop cancelled timers from the top of the heap
+                    while self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    remaining = self.heap[0][0] - time.monotonic()
+                    if remaining <= 0:
+                        timer = heapq.heappop(self.heap)[2]
+                        break
+                    self.cond.wait(remaining)
+                else:
+                    return
+            try:
+                timer.func(*timer.args)
+            except Exception:
+                self.logger.exception("@scheduler > Error running timer")
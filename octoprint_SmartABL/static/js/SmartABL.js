@@ -21,9 +21,68 @@ $(function() {
             var counter = $('#smartABL_counter')
 
             var restricted = $('#smartABL_restricted')
+            var always = $('#smartABL_always')
+            var status = {};
+
+            var heatmap = $('#smartabl_mesh .smartabl-heatmap')
+            var meshInfo = $('#smartabl_mesh .smartabl-mesh-info')
+            var meshEmpty = $('#smartabl_mesh .smartabl-mesh-empty')
+            var delta = $('#smartabl_mesh .smartabl-delta')
+
+            function showHeatmap() {
+                // images and data are rendered once per mesh by the server
+                var kind = delta.prop('checked') ? 'delta' : 'png';
+                heatmap.attr('src', API_BASEURL + "plugin/" + PLUGIN_ID + "?heatmap=" + kind + "&id=" + status.mesh_id);
+            }
+
+            function showMesh() {
+                if (status.mesh_id === null || status.mesh_id === undefined) {
+                    heatmap.hide();
+                    meshInfo.text('');
+                    meshEmpty.show();
+                    return;
+                }
+                $.ajax({
+                    url: API_BASEURL + "plugin/" + PLUGIN_ID + "?heatmap",
+                    type: "GET",
+                    dataType: "json"
+                }).done(function(mesh) {
+                    if (mesh.min === null) {
+                        // no point probed
+                        heatmap.hide();
+                        meshInfo.text('');
+                        meshEmpty.show();
+                        return;
+                    }
+                    var info = "Range: " + (mesh.max - mesh.min).toFixed(3) + "mm (" +
+                        mesh.min.toFixed(3) + "/" + mesh.max.toFixed(3) + "), bed: " + mesh.bedtemp + "ºC";
+                    if (mesh.delta_max !== null) {
+                        info += ", max. change: " + mesh.delta_max.toFixed(3) + "mm";
+                    } else {
+                        delta.prop('checked', false);
+                    }
+                    delta.prop('disabled', mesh.delta_max === null);
+                    meshInfo.text(info);
+                    meshEmpty.hide();
+                    showHeatmap();
+                    heatmap.show();
+                });
+            }
+
+            delta.change(showHeatmap);
+
+            function showMode(value) {
+                if (value) {
+                    always.addClass('btn-info');
+                    restricted.removeClass('btn-success');
+                } else {
+                    restricted.addClass('btn-success');
+                    always.removeClass('btn-info');
+                }
+            }
+
             restricted.click(function() {
-                restricted.addClass('btn-success');
-                always.removeClass('btn-info');
+                showMode(false);
                 $.ajax({
                     url: API_BASEURL + "plugin/" + PLUGIN_ID,
                     type: "POST",
@@ -36,10 +95,8 @@ $(function() {
                 });
             });
 
-            var always = $('#smartABL_always')
             always.click(function() {
-                always.addClass('btn-info');
-                restricted.removeClass('btn-success');
+                showMode(true);
                 $.ajax({
                     url: API_BASEURL + "plugin/" + PLUGIN_ID,
                     type: "POST",
@@ -56,14 +113,18 @@ $(function() {
                 if (plugin != PLUGIN_ID) {
                     return;
                 }
-                if (data.abl_always !== undefined) {
-                    if (data.abl_always) {
-                        always.click();
-                    } else {
-                        restricted.click();
+                if (data.status !== undefined) {
+                    // only the fields that changed since the last message
+                    $.extend(status, data.status);
+                    if (data.status.abl_always !== undefined) {
+                        showMode(status.abl_always);
+                    }
+                    if (data.status.prints !== undefined || data.status.prints_limit !== undefined) {
+                        counter.text(status.prints.toString().concat("/", status.prints_limit))
+                    }
+                    if (data.status.mesh_id !== undefined) {
+                        showMesh();
                     }
-                } else if (data.abl_counter !== undefined) {
-                    counter.text(data.abl_counter[0].toString().concat("/", data.abl_counter[1]))
                 } else {
                     new PNotify({
 						title: data.abl_notify[0],
@@ -0,0 +1,136 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+import time
+
+
+def _umask():
+    # read once at import, os.umask() can't be read without setting it
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+UMASK = _umask()
+
+
+def atomic_write(path, data, mode="w"):
+    folder = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(
+        prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=folder
+    )
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates it 0600, keep the mode of the file replaced
+        try:
+            perms = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            perms = 0o666 & ~UMASK
+        os.chmod(tmp, perms)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    # make the rename itself durable
+    try:
+        dir_fd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def load_json(path, logger=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        # keep the broken file around for bug reports and start over
+        os.replace(path, f"{path}.corrupt")
+        if logger is not None:
+            logger.warning(
+                f"@load_json > {path} is corrupted, moved to {path}.corrupt"
+            )
+        return None
+
+
+class BackgroundWriter:
+    def __init__(self, delay=0.5, logger=None):
+        self.delay = delay
+        self.logger = logger or logging.getLogger(__name__)
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        if self.thread is None:
+            self.stopped = False
+            self.thread = threading.Thread(
+                target=self._run, name="SmartABL writer", daemon=True
+            )
+            self.thread.start()
+
+    def schedule(self, key, func, *args):
+        # only the last write of each key is kept until the writer runs
+        with self.cond:
+            if not self.pending:
+                # the writer is only woken by the first write of a burst
+                self.cond.notify()
+            self.pending[key] = (func, args)
+        if self.thread is None:
+            self._write(self._take())
+
+    def stop(self, timeout=10):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+        self._write(self._take())
+
+    def _take(self):
+        with self.cond:
+            pending, self.pending = self.pending, {}
+        return pending
+
+    def _write(self, pending):
+        for key, (func, args) in pending.items():
+            try:
+                func(*args)
+            except Exception:
+                self.logger.exception(f"@writer > Error writing {key}")
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                # give bursts of updates the chance to coalesce
+                deadline = time.monotonic() + self.delay
+                remaining = self.delay
+                while remaining > 0 and not self.stopped:
+                    self.cond.wait(remaining)
+                    remaining = deadline - time.monotonic()
+            self._write(self._take())
@@ -0,0 +1,50 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import re
+from typing import NamedTuple, Optional
+
+BED_GCODES = frozenset(("M140", "M190"))
+TOOL_GCODES = frozenset(("M104", "M109"))
+TEMP_GCODES = BED_GCODES | TOOL_GCODES
+
+TEMP_REGX = re.compile(
+    r"^\s*(?P<gcode>M10[49]|M1[49]0)(?![\d.])(?P<params>[^;]*)", re.I
+)
+TOOL_REGX = re.compile(r"^\s*T(?P<tool>\d+)(?![\d.])", re.I)
+PARAM_REGX = re.compile(
+    r"(?P<param>[SRT])\s*(?P<value>[-+]?\d+(?:\.\d*)?)", re.I
+)
+
+
+class TempTarget(NamedTuple):
+    gcode: str
+    heater: str  # "bed" or "tool<n>"
+    target: float
+    wait: bool
+
+
+def parse_temp(cmd, tool=0) -> Optional[TempTarget]:
+    match = TEMP_REGX.match(cmd)
+    if match is None:
+        return None
+    gcode = match.group("gcode").upper()
+    params = {
+        param.group("param").upper(): float(param.group("value"))
+        for param in PARAM_REGX.finditer(match.group("params"))
+    }
+    # R waits while heating and cooling, it has precedence over S
+    target = params.get("R", params.get("S"))
+    if target is None:
+        return None
+    if gcode in BED_GCODES:
+        heater = "bed"
+    else:
+        heater = f"tool{int(params.get('T', tool))}"
+    return TempTarget(gcode, heater, target, gcode in ("M109", "M190"))
+
+
+def parse_tool(cmd) -> Optional[int]:
+    # OctoPrint reports every tool change as the "T" gcode
+    match = TOOL_REGX.match(cmd)
+    return int(match.group("tool")) if match is not None else None
@@ -0,0 +1,173 @@
+# coding=utf-8
+"""Hook overhead and end-to-end hold latency against emulated firmwares.
+
+Needs an environment with OctoPrint installed, e.g.:
+
+    python tools/bench_hooks.py -f marlin klipper -d 0.05 -n 20
+    python tools/bench_hooks.py -f prusa --missing
+    python tools/bench_hooks.py -f marlin -d 0.5 --early
+    python tools/bench_hooks.py --max-ns 20000 --max-hold 50
+
+Exits with 1 if a hook or the hold goes over the given limits.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from emulator import FILE_TAGS, VirtualPrinter  # noqa: E402
+from octoprint.util.comm import gcode_command_for_cmd  # noqa: E402
+
+FIRMWARES = ("marlin", "ubl", "prusa", "buddy", "klipper")
+
+
+def job(abl, layers=50, moves=200):
+    lines = ["; synthetic job", "M140 S60", "M104 S210", "M190 S60"]
+    lines += ["M109 S210", "G28", abl, "G92 E0"]
+    for layer in range(layers):
+        lines.append(f";LAYER:{layer}")
+        lines.append(f"G0 Z{0.2 * (layer + 1):.2f} F600")
+        for move in range(moves):
+            lines.append(
+                f"G1 X{10 + move % 200}.5 Y{10 + layer}.25 E{move * 0.03:.5f}"
+            )
+    return lines + ["M104 S0", "M140 S0", "M84"]
+
+
+def per_line(printer, lines, repeat):
+    plugin = printer.plugin
+    tags = set(FILE_TAGS)
+    parsed = [
+        (line, gcode_command_for_cmd(line))
+        for line in lines
+        if line and not line.startswith(";")
+    ]
+    # no trigger nor G28 in the timed loop, that is the common case
+    moves = [(cmd, gcode) for cmd, gcode in parsed if gcode in ("G0", "G1")]
+    received = ["ok", "ok T:210.00 /210.00 B:60.00 /60.00 @:0 B@:0"] * 50
+    results = {}
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for cmd, gcode in moves:
+            plugin.gcode_queuing(None, "queuing", cmd, None, gcode, tags=tags)
+    results["gcode_queuing"] = time.perf_counter() - start, len(moves)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for cmd, gcode in moves:
+            plugin.gcode_sent(None, "sent", cmd, None, gcode, tags=tags)
+    results["gcode_sent"] = time.perf_counter() - start, len(moves)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for line in received:
+            plugin.process_line(None, line)
+    results["process_line"] = time.perf_counter() - start, len(received)
+    per_line_ns = {}
+    for hook, (elapsed, count) in results.items():
+        per_line_ns[hook] = elapsed / (count * repeat) * 1e9
+        print(f"  {hook:>14}: {per_line_ns[hook]:8.1f} ns/line")
+    return per_line_ns
+
+
+def holds(firmware, prints, delay, missing, settings):
+    printer = VirtualPrinter(firmware, settings=settings)
+    printer.connect()
+    metadata = printer.plugin.profile.metadata
+    query = metadata["info"][0]
+    printer.emulator.delays[query] = delay
+    if missing:
+        printer.emulator.missing = (query,)
+    lines = job(metadata["abl"], layers=2, moves=10)
+    start = time.perf_counter()
+    for _ in range(prints):
+        printer.print_job(lines)
+    elapsed = time.perf_counter() - start
+    printer.close()
+    return printer, elapsed
+
+
+def report(label, values):
+    if not values:
+        print(f"  {label:>14}: no samples")
+        return None
+    values = sorted(values)
+    p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+    print(
+        f"  {label:>14}: n={len(values)} "
+        f"median={statistics.median(values) * 1e3:.2f}ms "
+        f"p95={p95 * 1e3:.2f}ms max={values[-1] * 1e3:.2f}ms"
+    )
+    return p95
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-f", "--firmware", nargs="+", default=FIRMWARES)
+    parser.add_argument("-r", "--repeat", type=int, default=20)
+    parser.add_argument("-n", "--prints", type=int, default=10)
+    parser.add_argument(
+        "-d", "--delay", type=float, default=0.0, help="mesh report delay"
+    )
+    parser.add_argument(
+        "--missing", action="store_true", help="mesh query never answered"
+    )
+    parser.add_argument(
+        "--early", action="store_true", help="query the mesh in advance"
+    )
+    parser.add_argument(
+        "--max-ns", type=float, help="fail over this time per line"
+    )
+    parser.add_argument(
+        "--max-hold", type=float, help="fail over this p95 hold (ms)"
+    )
+    args = parser.parse_args()
+
+    # debug logging would dominate the numbers
+    settings = dict(log_level="WARNING", early_query=args.early)
+    failures = []
+    for firmware in args.firmware:
+        print(f"{firmware}:")
+        printer = VirtualPrinter(firmware, settings=settings)
+        printer.connect()
+        abl = printer.plugin.profile.metadata["abl"]
+        per_line_ns = per_line(printer, job(abl), args.repeat)
+        printer.close()
+        if args.max_ns is not None:
+            failures += [
+                f"{firmware} {hook}: {ns:.1f} ns/line"
+                for hook, ns in per_line_ns.items()
+                if ns > args.max_ns
+            ]
+        printer, elapsed = holds(
+            firmware, args.prints, args.delay, args.missing, settings
+        )
+        p95 = report("hold", printer.holds)
+        if (
+            args.max_hold is not None
+            and p95 is not None
+            and p95 * 1e3 > args.max_hold
+        ):
+            failures.append(f"{firmware} hold: p95={p95 * 1e3:.2f}ms")
+        rtts = printer.plugin.state["rtt"].get(printer.plugin.firmware, [])
+        report("query rtt", rtts)
+        decisions = {
+            entry["labels"]["outcome"]: entry["value"]
+            for entry in printer.plugin.metrics.snapshot()["counters"].get(
+                "decisions_total", []
+            )
+        }
+        print(
+            f"  {'prints':>14}: {args.prints} in {elapsed:.2f}s "
+            f"decisions={decisions}"
+        )
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
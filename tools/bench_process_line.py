@@ -0,0 +1,92 @@
+# coding=utf-8
+"""Per-line cost of SmartABLPlugin.process_line on a serial.log.
+
+tools/data/serial.log is synthetic, written by hand in OctoPrint's format
+(its checksums aren't valid): pass a capture of the printer to measure
+real traffic. Needs an environment with OctoPrint installed, e.g.:
+
+    python tools/bench_process_line.py tools/data/serial.log -r 200
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from octoprint_SmartABL import SmartABLPlugin  # noqa: E402
+from octoprint_SmartABL.firmware import FirmwareRegistry  # noqa: E402
+from octoprint_SmartABL.machine import IDLE, QUERYING  # noqa: E402
+
+DEFAULT_LOG = os.path.join(os.path.dirname(__file__), "data", "serial.log")
+
+
+class _Printer:
+    def commands(self, *args, **kwargs):
+        pass
+
+    def set_job_on_hold(self, *args, **kwargs):
+        return True
+
+
+def received_lines(path):
+    lines = []
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for entry in f:
+            _, sep, line = entry.partition(" - Recv: ")
+            if sep:
+                lines.append(line.rstrip("\r\n"))
+    return lines
+
+
+def plugin(firmware):
+    instance = SmartABLPlugin()
+    instance.profile = FirmwareRegistry().load().get(firmware)
+    instance.firmware = firmware
+    instance._printer = _Printer()
+    instance._smartabl_logger = logging.getLogger("SmartABL.bench")
+    instance._smartabl_logger.disabled = True
+    return instance
+
+
+def run(instance, lines, repeat, querying):
+    process_line = instance.process_line
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            instance.machine.state = QUERYING if querying else IDLE
+            instance.mesh_parser = None
+            process_line(None, line)
+    return time.perf_counter() - start
+
+
+def baseline(instance, lines, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            instance.machine.state = IDLE
+            instance.mesh_parser = None
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("log", nargs="?", default=DEFAULT_LOG)
+    parser.add_argument("-r", "--repeat", type=int, default=100)
+    parser.add_argument("-f", "--firmware", default="marlin")
+    args = parser.parse_args()
+
+    lines = received_lines(args.log)
+    instance = plugin(args.firmware)
+    total = len(lines) * args.repeat
+    empty = baseline(instance, lines, args.repeat)
+    print(f"{len(lines)} received lines x {args.repeat} ({args.firmware})")
+    for label, querying in (("idle", False), ("querying", True)):
+        elapsed = run(instance, lines, args.repeat, querying) - empty
+        print(f"{label:>9}: {elapsed / total * 1e9:8.1f} ns/line")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,687 @@
+# coding=utf-8
+"""Scenario checks of the SmartABL decisions against emulated firmwares.
+
+Each check drives VirtualPrinter, or the synthetic serial.log in
+tools/data, and asserts the commands sent and the decisions taken.
+Exits with 1 if any check fails.
+
+Needs an environment with OctoPrint installed, e.g.:
+
+    python tools/check_scenarios.py
+    python tools/check_scenarios.py -k klipper library
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import octoprint.filemanager  # noqa: E402
+from emulator import VirtualPrinter  # noqa: E402
+from octoprint.util.comm import gcode_command_for_cmd  # noqa: E402
+from replay import Replay, parse  # noqa: E402
+
+import octoprint_SmartABL  # noqa: E402
+from octoprint_SmartABL.machine import (  # noqa: E402
+    DECIDING,
+    IDLE,
+    PROBING,
+    QUERYING,
+    StateMachine,
+)
+from octoprint_SmartABL.mesh import MeshParser, quality  # noqa: E402
+from octoprint_SmartABL.prescan import fingerprint  # noqa: E402
+from octoprint_SmartABL.storage import (  # noqa: E402
+    BackgroundWriter,
+    atomic_write,
+)
+from octoprint_SmartABL.temperature import parse_temp  # noqa: E402
+
+SERIAL_LOG = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "serial.log"
+)
+# settings of every printer, debug logging only slows the checks
+SETTINGS = dict(log_level="WARNING")
+# M420 V1 of marlin 2.1 UBL, (2, 1) not probed
+UBL_REPORT = """
+Bed Topography Report:
+
+    (  0,235)                      (235,235)
+        0       1       2       3       4
+ 4 | +0.148  +0.125  +0.090  +0.061  +0.030
+   |
+ 3 | +0.101  +0.078 [+0.050] +0.021  -0.012
+   |
+ 2 | +0.050  +0.027  +0.003  -0.025  -0.057
+   |
+ 1 | +0.011  -0.015          -0.066  -0.098
+   |
+ 0 | -0.030  -0.055  -0.081  -0.107  -0.140
+        0       1       2       3       4
+    (  0,  0)                      (235,  0)
+
+
+echo:Bed Leveling ON
+echo:Fade Height 10.00
+ok
+"""
+# commands sent between G28 and the first move: probing, then skipping
+DECISIONS = {
+    "marlin": (
+        ["M420 V1", "G29", "M420 V1", "M500"],
+        ["M420 V1", "M420 S1"],
+    ),
+    "ubl": (
+        ["M420 V1", "G29", "M420 V1", "M500"],
+        ["M420 V1", "M420 S1"],
+    ),
+    "prusa": (["G81", "G80", "G81"], ["G81"]),
+    # no M500 until the firmware reports Cap:EEPROM
+    "buddy": (["M420 V1", "G29", "M420 V1"], ["M420 V1"]),
+    "klipper": (
+        [
+            "BED_MESH_OUTPUT",
+            "BED_MESH_CALIBRATE",
+            "BED_MESH_OUTPUT",
+            "BED_MESH_PROFILE SAVE=default",
+        ],
+        ["BED_MESH_OUTPUT"],
+    ),
+}
+
+CHECKS = []
+
+
+def check(func):
+    CHECKS.append((func.__name__, func))
+    return func
+
+
+@contextlib.contextmanager
+def printer(firmware="marlin", **kwargs):
+    settings = dict(SETTINGS, **kwargs.pop("settings", {}))
+    vp = VirtualPrinter(firmware, settings=settings, **kwargs)
+    vp.connect()
+    try:
+        yield vp
+    finally:
+        vp.close()
+
+
+def job(vp, bedtemp=60):
+    abl = vp.plugin.profile.metadata["abl"]
+    return [f"M140 S{bedtemp}", f"M190 S{bedtemp}", "G28", abl, "G1 X1 E1"]
+
+
+def run(vp, lines, path=None):
+    """Prints the job, returns the outcome and what was sent for it."""
+    start = len(vp.sent)
+    vp.print_job(lines, path=path)
+    # the decision may be sent from the scheduler thread
+    time.sleep(0.1)
+    return vp.plugin.last_decision["outcome"], vp.sent[start:]
+
+
+def between(sent, first, last):
+    return sent[sent.index(first) + 1 : len(sent) - sent[::-1].index(last) - 1]
+
+
+def decisions(firmware):
+    def func():
+        probe, skip = DECISIONS[firmware]
+        with printer(firmware, settings=dict(prints=2)) as vp:
+            lines = job(vp)
+            expected = [("probed", probe), ("skip", skip)] * 2
+            for outcome, cmds in expected:
+                got, sent = run(vp, lines)
+                assert got == outcome, (got, outcome)
+                cmds_sent = between(sent, "G28", lines[-1])
+                assert cmds_sent == cmds, cmds_sent
+
+    func.__name__ = f"decisions_{firmware}"
+    return check(func)
+
+
+for _firmware in DECISIONS:
+    decisions(_firmware)
+
+
+@check
+def bed_temperature_change():
+    with printer(settings=dict(bedtemp=True)) as vp:
+        outcomes = [
+            run(vp, job(vp, bedtemp))[0] for bedtemp in (60, 60, 70, 70)
+        ]
+    assert outcomes == ["probed", "skip", "probed", "skip"], outcomes
+
+
+@check
+def temps_after_decision():
+    # changes of the nozzle temperature after the trigger don't count
+    with printer(settings=dict(hetemp=True)) as vp:
+        lines = job(vp)
+        lines[2:2] = ["M109 S215"]
+        lines += ["M104 S205", "G1 X2 E2"]
+        outcomes = [run(vp, lines)[0] for _ in range(3)]
+    assert outcomes == ["probed", "skip", "skip"], outcomes
+
+
+@check
+def tool_temps():
+    cmds = ["T1", "M104 S240", "M109 T0 S215", "M190 S85", "M104 S250"]
+    with printer(settings=dict(hetemp=True)) as vp:
+        vp.event("PrintStarted")
+        for cmd in cmds:
+            # file lines SmartABL doesn't change are only tagged source:file
+            vp.plugin.gcode_sent(
+                None,
+                "sent",
+                cmd,
+                None,
+                gcode_command_for_cmd(cmd),
+                tags={"source:file"},
+            )
+        job_temps = vp.plugin.job_temps
+        force_temp = vp.plugin.force_temp
+        matcher = vp.plugin.matcher
+    assert job_temps == dict(tool1=240, tool0=215, bed=85), job_temps
+    assert force_temp
+    folder = tempfile.mkdtemp(prefix="smartabl-check-")
+    try:
+        path = os.path.join(folder, "job.gcode")
+        with open(path, "w") as f:
+            f.write("\n".join(["M109 T1 S240"] + cmds) + "\n")
+        entry = octoprint_SmartABL.scan(
+            path, matcher, frozenset(("M109", "M190"))
+        )
+        temps = entry["temps"]
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    assert temps == dict(tool1=240, tool0=215, bed=85), temps
+
+
+@check
+def cleared_settings():
+    # numbers emptied in the settings form are read as None
+    cleared = [
+        "temp_tolerance",
+        "drift_threshold",
+        "heat_fraction",
+        "days",
+        "prints",
+        "temp_band",
+        "adaptive_margin",
+        "early_query_age",
+        "library_slots",
+        "quality_range",
+    ]
+    settings = dict(
+        {key: None for key in cleared},
+        bedtemp=True,
+        hetemp=True,
+        drift_check=True,
+        heat_probe=True,
+        predict=True,
+        quality_check=True,
+        mesh_bounds="10,10,210,210",
+    )
+    with printer(settings=settings) as vp:
+        lines = job(vp)
+        lines[2:2] = ["M109 S215"]
+        outcomes = [run(vp, lines)[0] for _ in range(2)]
+    assert outcomes == ["probed", "skip"], outcomes
+
+
+@check
+def drift_check_loads_after_probes():
+    settings = dict(drift_check=True, days=0, mesh_bounds="10,10,210,210")
+    with printer(settings=settings) as vp:
+        lines = job(vp)
+        run(vp, lines)
+        outcome, sent = run(vp, lines)
+    assert outcome == "drift_skip", outcome
+    probes = [i for i, cmd in enumerate(sent) if cmd.startswith("G30")]
+    assert probes and sent.index("M420 S1") > probes[-1], sent
+
+
+@check
+def drift_check_probe_area():
+    # bilinear doesn't report where the mesh was probed
+    with printer(settings=dict(drift_check=True, days=0)) as vp:
+        lines = job(vp)
+        run(vp, lines)
+        outcome, sent = run(vp, lines)
+    assert outcome == "probed", outcome
+    assert not any(cmd.startswith("G30") for cmd in sent), sent
+    with printer("ubl", settings=dict(drift_check=True, days=0)) as vp:
+        lines = job(vp)
+        run(vp, lines)
+        outcome, sent = run(vp, lines)
+    assert outcome == "drift_skip", outcome
+    assert "G30 X110.00 Y110.00" in sent, sent
+
+
+@check
+def library_ubl_slots():
+    with printer("ubl", settings=dict(library=True)) as vp:
+        lines = job(vp)
+        _, sent = run(vp, lines)
+        # the first report has no slots, saved once probed
+        assert "G29 S0" in sent, sent
+        vp.emulator.mesh = None
+        outcome, sent = run(vp, lines)
+    assert outcome == "library", outcome
+    assert "G29 L0" in sent, sent
+
+
+@check
+def library_klipper_restart():
+    with printer("klipper", settings=dict(library=True)) as vp:
+        lines = job(vp)
+        run(vp, lines)
+        assert vp.plugin.state["library"], "nothing stored"
+        # restarted without SAVE_CONFIG, the profiles are gone
+        vp.emulator.mesh = None
+        vp.emulator.slots = {}
+        outcome, sent = run(vp, lines)
+    assert outcome == "probed", outcome
+    assert not any("LOAD=smartabl" in cmd for cmd in sent), sent
+
+
+@check
+def klipper_reload_persisted():
+    with printer("klipper", settings=dict(save_config=True)) as vp:
+        lines = job(vp)
+        run(vp, lines)
+        # SAVE_CONFIG is queued when the print is over
+        assert vp.plugin.state["persisted"][vp.plugin.port]
+        vp.disconnect()
+        vp.emulator.mesh = None  # "default" only in printer.cfg
+        vp.connect()
+        outcome, sent = run(vp, lines)
+    assert outcome == "skip", outcome
+    assert "BED_MESH_PROFILE LOAD=default" in sent, sent
+
+
+@check
+def query_never_answered():
+    with printer(missing=("M420 V",)) as vp:
+        vp.plugin.query_timeout = dict(
+            vp.plugin.query_timeout, floor=0.1, ceiling=0.5
+        )
+        lines = job(vp)
+        for _ in range(4):
+            run(vp, lines)
+        assert vp.holds[0] >= 0.5, vp.holds
+        # the floor once the query has been missed three times in a row
+        assert vp.holds[-1] < 0.5, vp.holds
+        vp.emulator.missing = ()
+        run(vp, lines)
+        assert not vp.plugin.state["misses"], vp.plugin.state["misses"]
+
+
+@check
+def query_answered_late():
+    with printer(missing=("M420 V",)) as vp:
+        vp.plugin.query_timeout = dict(
+            vp.plugin.query_timeout, floor=0.1, ceiling=0.5
+        )
+        lines = job(vp)
+        for _ in range(3):
+            run(vp, lines)
+        assert vp.plugin._timeout() == 0.1, vp.plugin.state["misses"]
+        # slower than the floor, answered after the timeout
+        vp.emulator.missing = ()
+        vp.emulator.delays["M420 V"] = 0.25
+        run(vp, lines)
+        assert not vp.plugin.state["misses"], vp.plugin.state["misses"]
+        assert vp.plugin.state["rtt"]["marlin"][-1] >= 0.25
+        metrics = vp.plugin.metrics
+        timeouts = metrics.counter("query_timeouts_total", firmware="marlin")
+        run(vp, lines)
+        assert vp.holds[-1] >= 0.25, vp.holds
+        assert (
+            metrics.counter("query_timeouts_total", firmware="marlin")
+            == timeouts
+        )
+
+
+@check
+def index_after_print_started():
+    scan = octoprint_SmartABL.scan
+    started = threading.Event()
+
+    def slow_scan(*args, **kwargs):
+        # the file is selected and printed at once
+        started.wait(5)
+        return scan(*args, **kwargs)
+
+    folder = tempfile.mkdtemp(prefix="smartabl-check-")
+    octoprint_SmartABL.scan = slow_scan
+    try:
+        with printer(settings=dict(heat_probe=True)) as vp:
+            queuing = vp.plugin.gcode_queuing
+
+            def slow_queuing(comm, phase, cmd, *args, **kwargs):
+                started.set()
+                deadline = time.monotonic() + 5
+                # indexed before the bed wait is reached
+                while (
+                    cmd.startswith("M190")
+                    and vp.plugin.prescan.get(vp.plugin.job_key) is None
+                    and time.monotonic() < deadline
+                ):
+                    time.sleep(0.01)
+                return queuing(comm, phase, cmd, *args, **kwargs)
+
+            vp.plugin.gcode_queuing = slow_queuing
+            lines = job(vp)
+            lines.insert(2, "G1 X0 Y0")
+            path = os.path.join(folder, "job.gcode")
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            vp.event("FileSelected", dict(origin="local", path=path))
+            _, sent = run(vp, lines, path=path)
+    finally:
+        octoprint_SmartABL.scan = scan
+        shutil.rmtree(folder, ignore_errors=True)
+    assert vp.plugin.job_index is not None
+    # the bed wait deferred until the first move
+    assert sent[:4] == ["M140 S60", "M140 S60", "M190 S60", "G1 X0 Y0"], sent
+
+
+@check
+def adaptive_region():
+    folder = tempfile.mkdtemp(prefix="smartabl-check-")
+    try:
+        path = os.path.join(folder, "job.gcode")
+        sent = {}
+        for bounds in ("", "10,10,210,210"):
+            settings = dict(adaptive=True, mesh_bounds=bounds, prints=1)
+            with printer(settings=settings) as vp:
+                lines = job(vp)
+                lines[-1:] = ["G1 X100 Y100", "G1 X120 Y120 E1"]
+                with open(path, "w") as f:
+                    f.write("\n".join(lines) + "\n")
+                vp.event("FileSelected", dict(origin="local", path=path))
+                time.sleep(0.2)
+                # the region is only probed once a grid was reported
+                run(vp, lines, path=path)
+                _, sent[bounds] = run(vp, lines, path=path)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    # bilinear doesn't report the area the probe reaches
+    assert "G29" in sent[""], sent[""]
+    assert "G29 L90 R130 F90 B130" in sent["10,10,210,210"], sent
+
+
+@check
+def after_partial_mesh():
+    folder = tempfile.mkdtemp(prefix="smartabl-check-")
+    settings = dict(adaptive=True, mesh_bounds="10,10,210,210", prints=1)
+    try:
+        path = os.path.join(folder, "job.gcode")
+        with printer(settings=settings) as vp:
+            lines = job(vp)
+            lines[-1:] = ["G1 X100 Y100", "G1 X120 Y120 E1"]
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            vp.event("FileSelected", dict(origin="local", path=path))
+            time.sleep(0.2)
+            run(vp, lines, path=path)
+            meshes = len(vp.plugin.meshes.meshes)
+            _, sent = run(vp, lines, path=path)
+            assert "G29 L90 R130 F90 B130" in sent, sent
+            vp.plugin._settings.set(["drift_check"], True)
+            # the partial grid is reported again by the next query
+            outcome, sent = run(vp, lines, path=path)
+            stored = len(vp.plugin.meshes.meshes)
+            prints = vp.plugin.state["prints"]
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    assert stored == meshes, (stored, meshes)
+    # no drift check against the whole bed, the region is probed again
+    assert outcome == "probed", outcome
+    assert not any(cmd.startswith("G30") for cmd in sent), sent
+    assert prints >= 1, prints
+
+
+@check
+def preprocess_fingerprint():
+    with printer() as vp:
+        matcher = vp.plugin.matcher
+    assert fingerprint(matcher) != fingerprint(
+        matcher._replace(cmd_ignore=not matcher.cmd_ignore)
+    )
+
+
+@check
+def preprocess_marks():
+    class Upload:
+        filename = "job.gcode"
+
+        def __init__(self, data):
+            self.data = data
+
+        def stream(self):
+            return io.BytesIO(self.data)
+
+    filemanager = octoprint.filemanager
+    valid_file_type = filemanager.valid_file_type
+    # the extension tree needs OctoPrint's plugin manager
+    filemanager.valid_file_type = lambda path, type=None: path.endswith(
+        ".gcode"
+    )
+    settings = dict(preprocess=True, cmd_ignore=True, ignore_gcode="M420 S0")
+    try:
+        with printer(settings=settings) as vp:
+            lines = job(vp)
+            lines.insert(3, "M420 S0")
+            upload = Upload(("\n".join(lines) + "\n").encode())
+            assert vp.plugin.preprocess("job.stl", upload) is upload
+            marked = vp.plugin.preprocess("job.gcode", upload)
+            data = marked.stream().read().decode().splitlines()
+    finally:
+        filemanager.valid_file_type = valid_file_type
+    assert data[1:] == [
+        "M140 S60",
+        "M190 S60",
+        "G28",
+        "@SMARTABLMARK M420 S0",
+        "@SMARTABLMARK G29",
+        "G1 X1 E1",
+    ], data
+
+
+@check
+def mesh_report_log():
+    entries = parse(SERIAL_LOG)
+    meshes = []
+    parser = None
+    for _, kind, text in entries:
+        if kind == "send":
+            parser = MeshParser() if text == "M420 V1" else None
+        elif kind == "recv" and parser is not None:
+            if parser.feed(text):
+                meshes.append(parser.mesh(0, 60))
+                parser = None
+    assert len(meshes) == 1, meshes
+    mesh = meshes[0]
+    assert mesh.z.shape == (5, 5), mesh.z.shape
+    assert abs(mesh.z[0, 0] + 0.103) < 1e-6, mesh.z
+    assert abs(mesh.z[4, 4] - 0.119) < 1e-6, mesh.z
+    assert mesh.bounds is None, mesh.bounds
+
+
+@check
+def ubl_report():
+    parser = MeshParser(reverse=True)
+    lines = iter(UBL_REPORT.splitlines()[2:])
+    for line in lines:
+        if parser.feed(line + "\n"):
+            break
+    # the parser stops at the first line after the grid
+    assert next(lines) == "echo:Fade Height 10.00"
+    mesh = parser.mesh(0, 60)
+    assert mesh is not None, (parser.rows, parser.error)
+    assert mesh.z.shape == (5, 5), mesh.z.shape
+    assert abs(mesh.z[0, 0] + 0.030) < 1e-6, mesh.z
+    assert abs(mesh.z[3, 2] - 0.050) < 1e-6, mesh.z
+    assert abs(mesh.z[4, 0] - 0.148) < 1e-6, mesh.z
+    assert int(np.isnan(mesh.z).sum()) == 1 and np.isnan(mesh.z[1, 2])
+    assert mesh.bounds == (0, 0, 235, 235), mesh.bounds
+
+
+@check
+def bilinear_hole():
+    report = [
+        "      0      1      2",
+        " 0 +0.100 +0.120 +0.130",
+        " 1 +0.110  ===== +0.140",
+        " 2 +0.120 +0.130 +0.150",
+        "",
+        "echo:Bed Leveling ON",
+    ]
+    parser = MeshParser()
+    for line in report:
+        if parser.feed(line):
+            break
+    mesh = parser.mesh(0, 60)
+    assert mesh is not None, parser.error
+    assert mesh.z.shape == (3, 3), mesh.z
+    assert np.isnan(mesh.z[1, 1]) and int(np.isnan(mesh.z).sum()) == 1
+    # a row that can't be read isn't the end of the grid
+    parser = MeshParser()
+    for line in report[:2] + [" 1 +0.110 ?? +0.140"] + report[3:]:
+        if parser.feed(line):
+            break
+    assert parser.mesh(0, 60) is None and parser.error, parser.rows
+
+
+@check
+def degenerate_quality():
+    nan = np.nan
+    limits = dict(range=2.0, residual=1.0, outlier=0.3, missing=None)
+    for z in (
+        [[0.1, 0.2, 0.3]],
+        [[0.1, nan, nan], [0.2, nan, nan], [0.3, nan, nan]],
+    ):
+        issues = quality(z).issues(limits)
+        assert issues == ["degenerate"], (z, issues)
+    assert not quality([[0.1, 0.2], [0.1, 0.25]]).issues(limits)
+
+
+@check
+def ubl_mesh_stored():
+    for firmware in ("ubl", "buddy"):
+        with printer(firmware) as vp:
+            run(vp, job(vp))
+            last = vp.plugin.meshes.last
+        assert last is not None and last.z.shape == (5, 5), firmware
+        assert last.bounds == (10, 10, 210, 210), last.bounds
+
+
+@check
+def temps_log():
+    heaters = {}
+    for _, kind, text in parse(SERIAL_LOG):
+        temp = parse_temp(text) if kind == "send" else None
+        if temp is not None:
+            heaters[temp.gcode] = (temp.heater, temp.target, temp.wait)
+    assert heaters == {
+        "M140": ("bed", 60.0, False),
+        "M190": ("bed", 60.0, True),
+        "M109": ("tool0", 200.0, True),
+    }, heaters
+
+
+@check
+def replay_log():
+    replay = Replay(parse(SERIAL_LOG), dict(SETTINGS))
+    try:
+        replay.run()
+    finally:
+        replay.close()
+    outcomes = [outcome for _, outcome, _ in replay.decisions]
+    assert outcomes[-1] == "probed", replay.decisions
+    assert len(replay.holds) == 1, replay.holds
+
+
+@check
+def writer_coalesces():
+    writes = []
+    writer = BackgroundWriter(delay=0.3)
+    writer.start()
+    try:
+        for i in range(20):
+            writer.schedule("state", writes.append, i)
+            time.sleep(0.01)
+        time.sleep(0.5)
+    finally:
+        writer.stop()
+    assert writes == [19], writes
+
+
+@check
+def atomic_write_mode():
+    folder = tempfile.mkdtemp(prefix="smartabl-check-")
+    try:
+        path = os.path.join(folder, "state.json")
+        with open(path, "w") as f:
+            f.write("{}")
+        os.chmod(path, 0o640)
+        atomic_write(path, "{}")
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    assert mode == 0o640, oct(mode)
+
+
+@check
+def state_machine():
+    machine = StateMachine()
+    assert not machine.transition(PROBING, "abl")
+    assert machine.state == IDLE
+    for target in (QUERYING, DECIDING, PROBING, IDLE):
+        assert machine.transition(target, "check"), (machine.state, target)
+    assert not machine.reset("check")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "-k", nargs="+", default=[], help="only checks with these words"
+    )
+    args = parser.parse_args()
+
+    failed = 0
+    for name, func in CHECKS:
+        if args.k and not any(word in name for word in args.k):
+            continue
+        start = time.perf_counter()
+        try:
+            func()
+        except Exception:
+            failed += 1
+            print(f"FAIL {name}")
+            traceback.print_exc(file=sys.stdout)
+        else:
+            print(f"  ok {name} ({time.perf_counter() - start:.2f}s)")
+    if failed:
+        print(f"{failed} failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
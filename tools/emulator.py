@@ -0,0 +1,526 @@
+# coding=utf-8
+"""Stand-in printer and OctoPrint objects to drive SmartABL hooks locally.
+
+FirmwareEmulator answers the commands SmartABL cares about like Marlin,
+Prusa, Prusa-buddy or Klipper do. VirtualPrinter plays the role of
+OctoPrint's comm layer: it streams a job through gcode_queuing,
+at_command, gcode_sent and process_line, honouring job holds.
+
+    from emulator import VirtualPrinter
+    printer = VirtualPrinter("klipper", settings=dict(drift_check=True))
+    printer.connect()
+    printer.print_job(["G28", "BED_MESH_CALIBRATE", "G1 X10"])
+    printer.close()
+"""
+
+import collections
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from octoprint.util.comm import gcode_command_for_cmd  # noqa: E402
+
+from octoprint_SmartABL import SmartABLPlugin  # noqa: E402
+
+BANNERS = {
+    "marlin": (
+        "FIRMWARE_NAME:Marlin 2.1.2.1 (Feb  1 2024 12:00:00) "
+        "SOURCE_CODE_URL:github.com/MarlinFirmware/Marlin "
+        "PROTOCOL_VERSION:1.0 MACHINE_TYPE:Ender-3 V2 EXTRUDER_COUNT:1 "
+        "UUID:cede2a2f-41a2-4748-9b12-c55c62f367ff"
+    ),
+    "ubl": (
+        "FIRMWARE_NAME:Marlin 2.1.2.1 (Feb  1 2024 12:00:00) "
+        "SOURCE_CODE_URL:github.com/MarlinFirmware/Marlin "
+        "PROTOCOL_VERSION:1.0 MACHINE_TYPE:Ender-3 V2 UBL EXTRUDER_COUNT:1"
+    ),
+    "prusa": (
+        "FIRMWARE_NAME:Prusa-Firmware 3.13.2 based on Marlin "
+        "FIRMWARE_URL:https://github.com/prusa3d/Prusa-Firmware "
+        "PROTOCOL_VERSION:1.0 MACHINE_TYPE:Prusa i3 MK3S EXTRUDER_COUNT:1"
+    ),
+    "buddy": (
+        "FIRMWARE_NAME:Prusa-Firmware-Buddy 5.1.2 (Github) "
+        "SOURCE_CODE_URL:https://github.com/prusa3d/Prusa-Firmware-Buddy "
+        "PROTOCOL_VERSION:1.0 MACHINE_TYPE:Prusa-MK4 EXTRUDER_COUNT:1"
+    ),
+    "klipper": "FIRMWARE_NAME:Klipper FIRMWARE_VERSION:v0.12.0-114",
+}
+# tags of the file lines, OctoPrint adds REWRITE_TAGS to the ones a
+# hook changed
+FILE_TAGS = frozenset(("source:file",))
+API_TAGS = frozenset(("source:api",))
+REWRITE_TAGS = frozenset(
+    ("source:rewrite", "phase:queuing", "plugin:SmartABL")
+)
+CAPABILITIES = {
+    "marlin": ["EEPROM:1", "AUTOLEVEL:1", "Z_PROBE:1", "LEVELING_DATA:1"],
+    "ubl": ["EEPROM:1", "AUTOLEVEL:1", "Z_PROBE:1", "LEVELING_DATA:1"],
+    "prusa": [],
+    "buddy": ["AUTOLEVEL:1", "Z_PROBE:1", "LEVELING_DATA:1"],
+    "klipper": [],
+}
+
+
+class FirmwareEmulator:
+    def __init__(
+        self,
+        firmware="marlin",
+        size=5,
+        bounds=(10.0, 10.0, 210.0, 210.0),
+        eeprom=True,
+        delays=None,
+        missing=(),
+        probe_time=0.0,
+        offset=0.0,
+    ):
+        self.firmware = firmware
+        self.size = size
+        self.bounds = bounds
+        self.eeprom = eeprom
+        # seconds before answering, by command prefix
+        self.delays = dict(delays or {})
+        # command prefixes that never get an answer
+        self.missing = tuple(missing)
+        self.probe_time = probe_time
+        # physical bed: a tilted plane plus some bumps, moved by offset
+        self.offset = offset
+        self.mesh = None
+        self.slots = {}
+        self.targets = dict(bed=0.0, tool0=0.0)
+
+    def bed(self, x, y):
+        min_x, min_y, max_x, max_y = self.bounds
+        fx = (x - min_x) / (max_x - min_x)
+        fy = (y - min_y) / (max_y - min_y)
+        return round(
+            0.08 * fx - 0.05 * fy + 0.03 * ((fx - 0.5) ** 2) + self.offset, 4
+        )
+
+    def probe_mesh(self, region=None):
+        min_x, min_y, max_x, max_y = region or self.bounds
+        step_x = (max_x - min_x) / (self.size - 1)
+        step_y = (max_y - min_y) / (self.size - 1)
+        return [
+            [
+                self.bed(min_x + i * step_x, min_y + j * step_y)
+                for i in range(self.size)
+            ]
+            for j in range(self.size)
+        ]
+
+    def banner(self):
+        lines = [BANNERS[self.firmware]]
+        lines += [f"Cap:{cap}" for cap in CAPABILITIES[self.firmware]]
+        return lines + ["ok"]
+
+    def handle(self, cmd):
+        """Returns the response lines for cmd, None if it gets no answer."""
+        if self.missing and cmd.startswith(self.missing):
+            return None
+        for prefix, delay in self.delays.items():
+            if cmd.startswith(prefix):
+                time.sleep(delay)
+        words = cmd.split()
+        gcode = words[0].upper() if words else ""
+        handler = getattr(self, f"_{self.firmware}", None)
+        lines = handler(gcode, words) if handler else None
+        if lines is None:
+            lines = self._common(gcode, words)
+        return lines + ["ok"]
+
+    def _common(self, gcode, words):
+        if gcode == "M115":
+            return self.banner()[:-1]
+        if gcode in ("M140", "M190", "M104", "M109"):
+            for word in words[1:]:
+                if word[:1] in "SR":
+                    heater = "bed" if gcode in ("M140", "M190") else "tool0"
+                    self.targets[heater] = float(word[1:])
+        return []
+
+    # Marlin bilinear
+    def _marlin(self, gcode, words):
+        if gcode == "M420" and "V1" in words:
+            if self.mesh is None:
+                return ["echo:Invalid mesh.", "echo:Bed Leveling OFF"]
+            return self._bilinear_report() + ["echo:Bed Leveling ON"]
+        if gcode == "M420":
+            return ["echo:Bed Leveling ON" if self.mesh else "Invalid mesh."]
+        if gcode == "G29":
+            time.sleep(self.probe_time)
+            params = {word[0]: float(word[1:]) for word in words[1:]}
+            region = None
+            if all(axis in params for axis in "LFRB"):
+                region = tuple(params[axis] for axis in "LFRB")
+            self.mesh = self.probe_mesh(region)
+            return self._bilinear_report()
+        if gcode == "G30":
+            return self._g30(words)
+        if gcode == "M421":
+            params = {word[0]: word[1:] for word in words[1:]}
+            if self.mesh is None:
+                self.mesh = [[0.0] * self.size for _ in range(self.size)]
+            self.mesh[int(params["J"])][int(params["I"])] = float(params["Z"])
+            return []
+        if gcode == "M500":
+            return (
+                ["echo:Settings Stored"]
+                if self.eeprom
+                else ["echo:EEPROM disabled"]
+            )
+        return None
+
+    def _bilinear_report(self):
+        lines = ["Bilinear Leveling Grid:"]
+        lines.append(
+            "      " + "      ".join(str(i) for i in range(self.size))
+        )
+        for j, row in enumerate(self.mesh):
+            # points not probed are printed as "====="
+            lines.append(
+                f" {j} "
+                + " ".join(f"{z:+.3f}" if z == z else " =====" for z in row)
+            )
+        return lines + [""]
+
+    def _g30(self, words):
+        params = {word[0]: float(word[1:]) for word in words[1:]}
+        x, y = params.get("X", 110.0), params.get("Y", 110.0)
+        return [f"Bed X: {x:.2f} Y: {y:.2f} Z: {self.bed(x, y) + 1.0:.3f}"]
+
+    # Marlin UBL, also Prusa-buddy
+    def _ubl(self, gcode, words):
+        if gcode == "M420" and "V1" in words:
+            if self.mesh is None:
+                return ["Invalid mesh."]
+            return self._ubl_report()
+        if gcode == "G29":
+            params = {word[0]: word[1:] for word in words[1:]}
+            if "S" in params:
+                self.slots[params["S"]] = [row[:] for row in self.mesh]
+                return [f"Mesh saved in slot {params['S']}"]
+            if "L" in params:
+                if params["L"] not in self.slots:
+                    return ["?Invalid slot."]
+                self.mesh = [row[:] for row in self.slots[params["L"]]]
+                return [f"Mesh loaded from slot {params['L']}"]
+            time.sleep(self.probe_time)
+            self.mesh = self.probe_mesh()
+            return []
+        return self._marlin(gcode, words)
+
+    _buddy = _ubl
+
+    def _ubl_report(self):
+        # display_map() of marlin 2.x: back row first, blanks for the
+        # points not probed and the nozzle position in brackets
+        min_x, min_y, max_x, max_y = self.bounds
+        cols = len(self.mesh[0])
+        twixt = " " * (8 * cols - 18)
+
+        def corners(y):
+            return f"    ({min_x:3.0f},{y:3.0f}){twixt}({max_x:3.0f},{y:3.0f})"
+
+        labels = " " * 7 + "".join(f"{i:>2}      " for i in range(cols))
+        lines = ["", "Bed Topography Report:", ""]
+        lines.append(corners(max_y))
+        lines.append(labels)
+        nozzle = (cols // 2, len(self.mesh) // 2)
+        for j in reversed(range(len(self.mesh))):
+            row = f"{j:>2} |"
+            for i, z in enumerate(self.mesh[j]):
+                if z != z:  # nan
+                    value = " " * 6
+                else:
+                    value = f"{z:+.3f}" if z else " 0.000"
+                if (i, j) == nozzle:
+                    row += f"[{value}]"
+                else:
+                    row += f" {value} "
+            lines.append(row)
+            if j:
+                lines.append("   |")
+        lines.append(labels)
+        lines.append(corners(min_y))
+        return lines + ["", ""]
+
+    # Prusa MK3
+    def _prusa(self, gcode, words):
+        if gcode == "G81":
+            if self.mesh is None:
+                return ["Mesh bed leveling not active."]
+            lines = [
+                f"Num X,Y: {self.size},{self.size}",
+                "Z search height: 5.00",
+                "Measured points:",
+            ]
+            for row in reversed(self.mesh):
+                lines.append(" ".join(f"{z:+.5f}" for z in row))
+            return lines
+        if gcode == "G80":
+            time.sleep(self.probe_time)
+            self.mesh = self.probe_mesh()
+            return []
+        return None
+
+    # Klipper, through OctoPrint's "// " responses
+    def _klipper(self, gcode, words):
+        if gcode == "BED_MESH_OUTPUT":
+            if self.mesh is None:
+                return ["// Bed has not been probed"]
+            lines = ["// Mesh Leveling Probed Z positions:"]
+            for row in self.mesh:
+                lines.append("//   " + " ".join(f"{z:.6f}" for z in row))
+            lines.append(f"// Mesh X,Y: {self.size},{self.size}")
+            lines.append("// Search Height: 5")
+            return lines
+        if gcode == "BED_MESH_CALIBRATE":
+            time.sleep(self.probe_time)
+            self.mesh = self.probe_mesh()
+            return []
+        if gcode == "BED_MESH_PROFILE":
+            params = dict(
+                word.split("=", 1) for word in words[1:] if "=" in word
+            )
+            if "SAVE" in params:
+                self.slots[params["SAVE"]] = [row[:] for row in self.mesh]
+                return [
+                    f"// Bed Mesh state has been saved to profile "
+                    f"[{params['SAVE']}]"
+                ]
+            if "LOAD" in params:
+                if params["LOAD"] not in self.slots:
+                    return [f"!! bed_mesh: Unknown profile [{params['LOAD']}]"]
+                self.mesh = [row[:] for row in self.slots[params["LOAD"]]]
+                return []
+        if gcode == "G0":
+            params = {word[0]: float(word[1:]) for word in words[1:]}
+            self.position = (
+                params.get("X", getattr(self, "position", (110, 110))[0]),
+                params.get("Y", getattr(self, "position", (110, 110))[1]),
+            )
+            return []
+        if gcode == "PROBE":
+            x, y = getattr(self, "position", (110.0, 110.0))
+            return [
+                f"// probe at {x:.3f},{y:.3f} is z={self.bed(x, y) + 2.0:.6f}"
+            ]
+        return None
+
+
+class Settings:
+    def __init__(self, plugin, overrides, folder):
+        self.data = plugin.get_settings_defaults()
+        self.data.update(overrides or {})
+        self.folder = folder
+
+    def get(self, path, **kwargs):
+        return self.data.get(path[0])
+
+    def get_int(self, path, **kwargs):
+        value = self.data.get(path[0])
+        return None if value is None else int(value)
+
+    def get_float(self, path, **kwargs):
+        value = self.data.get(path[0])
+        return None if value is None else float(value)
+
+    def get_boolean(self, path, **kwargs):
+        return bool(self.data.get(path[0]))
+
+    def set(self, path, value, **kwargs):
+        self.data[path[0]] = value
+
+    def get_plugin_logfile_path(self):
+        return os.path.join(self.folder, "plugin_SmartABL.log")
+
+
+class PluginManager:
+    def __init__(self):
+        self.messages = []
+
+    def send_plugin_message(self, identifier, data):
+        self.messages.append(data)
+
+
+class PrinterProfileManager:
+    def __init__(self, width=220, depth=220):
+        self.profile = dict(volume=dict(width=width, depth=depth))
+
+    def get_current_or_default(self):
+        return self.profile
+
+
+class FileManager:
+    def path_on_disk(self, storage, path):
+        return path
+
+
+class VirtualPrinter:
+    """Minimal comm layer: OctoPrint's printer API backed by an emulator."""
+
+    def __init__(
+        self, firmware="marlin", settings=None, data_folder=None, **emulator
+    ):
+        self.emulator = FirmwareEmulator(firmware, **emulator)
+        self.own_folder = data_folder is None
+        self.folder = data_folder or tempfile.mkdtemp(prefix="smartabl-")
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.on_hold = False
+        self.holds = []
+        self.hold_start = None
+        self.sent = []
+        self.received = []
+        self.plugin = plugin = SmartABLPlugin()
+        plugin._identifier = "SmartABL"
+        plugin._plugin_name = "SmartABL"
+        plugin._plugin_version = "emulator"
+        plugin._settings = Settings(plugin, settings, self.folder)
+        plugin._printer = self
+        plugin._plugin_manager = PluginManager()
+        plugin._printer_profile_manager = PrinterProfileManager()
+        plugin._file_manager = FileManager()
+        plugin.get_plugin_data_folder = lambda: self.folder
+        plugin.initialize()
+
+    # OctoPrint printer API used by the plugin
+    def commands(self, commands, tags=None, **kwargs):
+        if isinstance(commands, str):
+            commands = [commands]
+        with self.cond:
+            self.queue.extend(commands)
+            self.cond.notify()
+
+    def set_job_on_hold(self, value, **kwargs):
+        with self.cond:
+            if value and not self.on_hold:
+                self.hold_start = time.perf_counter()
+            elif not value and self.on_hold:
+                self.holds.append(time.perf_counter() - self.hold_start)
+            self.on_hold = value
+            self.cond.notify()
+        return True
+
+    def get_current_temperatures(self):
+        return {
+            "bed": dict(
+                actual=self.emulator.targets["bed"],
+                target=self.emulator.targets["bed"],
+            ),
+            "tool0": dict(
+                actual=self.emulator.targets["tool0"],
+                target=self.emulator.targets["tool0"],
+            ),
+        }
+
+    # comm layer
+    def connect(self):
+        self.plugin.on_event("Connected", dict(port="VIRTUAL"))
+        self._receive(self.emulator.banner())
+
+    def disconnect(self):
+        self.plugin.on_event("Disconnected", {})
+
+    def event(self, event, payload=None):
+        self.plugin.on_event(event, payload or {})
+
+    def print_job(self, lines, path=None, timeout=30):
+        payload = dict(origin="local", path=path, name=path) if path else {}
+        self.event("PrintStarted", payload)
+        lines = iter(lines)
+        while True:
+            cmd = self._next(lines, timeout)
+            if cmd is None:
+                break
+            self._send(cmd, file=False)
+        self.event("PrintDone", payload)
+
+    def close(self):
+        self.plugin.on_shutdown()
+        if self.own_folder:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _next(self, lines, timeout):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while not self.queue and self.on_hold:
+                # watchdog/decision from another thread releases it
+                if not self.cond.wait(deadline - time.monotonic()):
+                    raise TimeoutError("Job held and nothing to send")
+            if self.queue:
+                return self.queue.popleft()
+        for line in lines:
+            cmd = line.split(";", 1)[0].strip()
+            if not cmd:
+                continue
+            self._send(cmd, file=True)
+            with self.cond:
+                if self.queue:
+                    return self.queue.popleft()
+                if self.on_hold:
+                    return self._next(lines, timeout)
+        with self.cond:
+            return self.queue.popleft() if self.queue else None
+
+    def _send(self, cmd, file):
+        gcode = gcode_command_for_cmd(cmd)
+        if file:
+            results = self.plugin.gcode_queuing(
+                None, "queuing", cmd, None, gcode, tags=set(FILE_TAGS)
+            )
+            results = results if isinstance(results, list) else [results]
+        else:
+            results = [cmd]
+        for result in results:
+            if result is None:
+                continue
+            if not file:
+                tags = set(API_TAGS)
+            elif result == cmd:
+                tags = set(FILE_TAGS)
+            else:
+                tags = set(FILE_TAGS | REWRITE_TAGS)
+            if isinstance(result, (list, tuple)):
+                self.commands(list(result))
+                continue
+            if result.startswith("@"):
+                words = result[1:].split(None, 1)
+                self.plugin.at_command(
+                    None,
+                    "sending",
+                    words[0],
+                    words[1] if len(words) > 1 else "",
+                    tags=tags,
+                )
+                continue
+            result_gcode = gcode_command_for_cmd(result)
+            self.sent.append(result)
+            self.plugin.gcode_sent(
+                None, "sent", result, None, result_gcode, tags=tags
+            )
+            self._receive(self.emulator.handle(result))
+
+    def _receive(self, lines):
+        for line in lines or ():
+            self.received.append(line)
+            self.plugin.process_line(None, line)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    for firmware in ("marlin", "ubl", "prusa", "buddy", "klipper"):
+        printer = VirtualPrinter(firmware)
+        printer.connect()
+        abl = printer.plugin.profile.metadata["abl"]
+        for _ in range(2):
+            printer.print_job(["M190 S60", "G28", abl, "G1 X10 Y10"])
+        print(f"{firmware:>8}: sent={printer.sent}")
+        printer.close()
@@ -0,0 +1,445 @@
+# coding=utf-8
+"""Replay a recorded OctoPrint serial.log through the SmartABL hooks.
+
+The lines sent while printing are streamed through gcode_queuing and
+gcode_sent as file lines and the received ones through process_line.
+The mesh query SmartABL sent in the recording, and the commands of its
+decision, are replaced by the ABL trigger so the replayed plugin decides
+again with the given settings and state. Its own commands are answered
+with the responses recorded for the same commands. Prints the decisions,
+the holds (with the recorded response times) and the time per hook.
+
+tools/data/serial.log is synthetic, a Marlin bilinear print written by
+hand in OctoPrint's format, not a capture. Needs an environment with
+OctoPrint installed, e.g.:
+
+    python tools/replay.py tools/data/serial.log
+    python tools/replay.py serial.log --state state.json -o days=3
+    python tools/replay.py serial.log --settings config.yaml --profile 20
+"""
+
+import argparse
+import bisect
+import collections
+import cProfile
+import json
+import os
+import pstats
+import re
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+# the emulator puts the repository in sys.path
+from emulator import (
+    API_TAGS,
+    FILE_TAGS,
+    REWRITE_TAGS,
+    FileManager,
+    PluginManager,
+    PrinterProfileManager,
+    Settings,
+)
+from octoprint.util.comm import gcode_command_for_cmd
+
+from octoprint_SmartABL import SmartABLPlugin
+from octoprint_SmartABL.temperature import parse_temp
+
+STATE_REGX = re.compile(r'Changing monitoring state from ".+" to "(.+)"')
+SEND_REGX = re.compile(r"^N\d+\s+(.*?)\*\d+$")
+# sent by OctoPrint itself, never part of the file
+HOST_GCODES = frozenset(("M105", "M110", "M114", "M115", "M155", "M27"))
+
+
+def parse(path):
+    entries = []
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for raw in f:
+            stamp, sep, text = raw.rstrip("\r\n").partition(" - ")
+            if not sep:
+                continue
+            try:
+                ts = datetime.strptime(
+                    stamp, "%Y-%m-%d %H:%M:%S,%f"
+                ).timestamp()
+            except ValueError:
+                continue
+            if text.startswith("Send: "):
+                match = SEND_REGX.match(text[6:])
+                cmd = match.group(1) if match else text[6:].strip()
+                entries.append((ts, "send", cmd))
+            elif text.startswith("Recv: "):
+                entries.append((ts, "recv", text[6:]))
+            else:
+                match = STATE_REGX.search(text)
+                if match is not None:
+                    entries.append((ts, "state", match.group(1)))
+    return entries
+
+
+class RecordedFirmware:
+    """Answers each command with the response recorded for it."""
+
+    def __init__(self, entries):
+        self.responses = collections.defaultdict(list)
+        current = None
+        for ts, kind, text in entries:
+            if kind == "send":
+                current = (ts, [])
+                self.responses[text].append(current)
+            elif kind == "recv" and current is not None:
+                current[1].append((ts, text))
+        self.times = {
+            cmd: [sent for sent, _ in responses]
+            for cmd, responses in self.responses.items()
+        }
+
+    def answer(self, cmd, now):
+        """Returns the response lines and how long the printer took."""
+        responses = self.responses.get(cmd)
+        if not responses:
+            return ["ok"], 0.0
+        # the first one recorded from now on, the last one otherwise
+        idx = min(bisect.bisect_left(self.times[cmd], now), len(responses) - 1)
+        sent, lines = responses[idx]
+        if not lines:
+            return ["ok"], 0.0
+        return [text for _, text in lines], lines[-1][0] - sent
+
+
+class Replay:
+    """OctoPrint's printer API fed from a recording."""
+
+    def __init__(self, entries, settings=None, state=None, profile=False):
+        self.entries = entries
+        self.firmware = RecordedFirmware(entries)
+        self.folder = tempfile.mkdtemp(prefix="smartabl-replay-")
+        if state is not None:
+            shutil.copy(state, os.path.join(self.folder, "state.json"))
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.on_hold = False
+        self.hold_start = None
+        self.holds = []  # (recorded time, recorded seconds, wall seconds)
+        self.clock = 0.0  # recorded time plus the answers replayed
+        self.temps = dict(bed=0.0, tool0=0.0)
+        self.printing = False
+        self.prints = 0
+        self.dropping = False
+        self.sent = []
+        self.decisions = []
+        self.hooks = collections.defaultdict(lambda: [0, 0.0])
+        self.profiler = cProfile.Profile() if profile else None
+        self.plugin = plugin = SmartABLPlugin()
+        plugin._identifier = "SmartABL"
+        plugin._plugin_name = "SmartABL"
+        plugin._plugin_version = "replay"
+        plugin._settings = Settings(plugin, settings, self.folder)
+        plugin._printer = self
+        plugin._plugin_manager = PluginManager()
+        plugin._printer_profile_manager = PrinterProfileManager()
+        plugin._file_manager = FileManager()
+        plugin.get_plugin_data_folder = lambda: self.folder
+        plugin.initialize()
+        self.last_decision = plugin.last_decision
+
+    # OctoPrint printer API used by the plugin
+    def commands(self, commands, tags=None, **kwargs):
+        if isinstance(commands, str):
+            commands = [commands]
+        with self.cond:
+            self.queue.extend(commands)
+            self.cond.notify()
+
+    def set_job_on_hold(self, value, **kwargs):
+        with self.cond:
+            if value and not self.on_hold:
+                self.hold_start = (self.clock, time.perf_counter())
+            elif not value and self.on_hold:
+                start, wall = self.hold_start
+                self.holds.append(
+                    (start, self.clock - start, time.perf_counter() - wall)
+                )
+            self.on_hold = value
+            self.cond.notify()
+        return True
+
+    def get_current_temperatures(self):
+        return {
+            heater: dict(actual=target, target=target)
+            for heater, target in self.temps.items()
+        }
+
+    # replay
+    def run(self, timeout=30):
+        implicit = not any(
+            kind == "state" and text in ("Printing", "Starting")
+            for _, kind, text in self.entries
+        )
+        self._event("Connected", dict(port="REPLAY"))
+        skip = False
+        for ts, kind, text in self.entries:
+            self.clock = max(self.clock, ts)
+            if kind == "state":
+                self._state(text)
+            elif kind == "send":
+                gcode = gcode_command_for_cmd(text)
+                if implicit and not self.printing and gcode not in HOST_GCODES:
+                    # no state changes in the log, print from the start
+                    self._event("PrintStarted", {})
+                skip = not self._send(text, gcode, timeout)
+            elif not skip:
+                self._call("process_line", None, text)
+                self._pump()
+        if self.printing:
+            self._event("PrintDone", {})
+
+    def close(self):
+        self.plugin.on_shutdown()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _call(self, hook, *args, **kwargs):
+        if self.profiler is not None:
+            self.profiler.enable()
+        start = time.perf_counter()
+        result = getattr(self.plugin, hook)(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        if self.profiler is not None:
+            self.profiler.disable()
+        stats = self.hooks[hook]
+        stats[0] += 1
+        stats[1] += elapsed
+        decision = self.plugin.last_decision
+        if decision is not self.last_decision and decision is not None:
+            self.decisions.append(
+                (self.clock, decision["outcome"], decision["reason"])
+            )
+        self.last_decision = decision
+        return result
+
+    def _event(self, event, payload):
+        if event == "PrintStarted":
+            self.printing = True
+            self.prints += 1
+        elif event in ("PrintDone", "PrintFailed", "Disconnected"):
+            self.printing = False
+        self._call("on_event", event, payload)
+        self._pump()
+
+    def _state(self, state):
+        if state in ("Printing", "Starting") and not self.printing:
+            self._event("PrintStarted", {})
+        elif state in ("Operational", "Finishing") and self.printing:
+            self._event("PrintDone", {})
+        elif state in ("Cancelling", "Error") and self.printing:
+            self._event("PrintFailed", {})
+        elif state in ("Offline", "Closed"):
+            self._event("Disconnected", {})
+
+    def _send(self, cmd, gcode, timeout):
+        """Returns whether the response recorded for cmd is replayed."""
+        self._track_temp(cmd)
+        if not self.printing or gcode in HOST_GCODES:
+            return True
+        profile = self.plugin.profile
+        if profile is not None and cmd == profile.metadata["info"][0]:
+            # the mesh query of the recorded plugin: the trigger was here
+            self.dropping = True
+            cmd = self._trigger()
+            gcode = gcode_command_for_cmd(cmd)
+        elif self.dropping and cmd.split()[0].upper() in self._outputs():
+            return False
+        else:
+            self.dropping = False
+        self._wait_hold(timeout)
+        results = self._call(
+            "gcode_queuing",
+            None,
+            "queuing",
+            cmd,
+            None,
+            gcode,
+            tags=set(FILE_TAGS),
+        )
+        live = False
+        for result in results or ():
+            if result == cmd and not self.dropping:
+                live = True
+                self.sent.append((self.clock, cmd))
+                self._call(
+                    "gcode_sent",
+                    None,
+                    "sent",
+                    cmd,
+                    None,
+                    gcode,
+                    tags=set(FILE_TAGS),
+                )
+            elif result is not None:
+                # changed by the hook, tagged like OctoPrint does
+                self._dispatch(result, FILE_TAGS | REWRITE_TAGS)
+        self._pump()
+        return live
+
+    def _trigger(self):
+        plugin = self.plugin
+        if plugin._settings.get(["trigger_custom"]):
+            return plugin._settings.get(["trigger_gcode"]).split(",")[0]
+        return plugin.profile.metadata["abl"]
+
+    def _outputs(self):
+        # gcodes SmartABL sends after its mesh query
+        metadata = self.plugin.profile.metadata
+        cmds = [metadata["info"][0], metadata["abl"]]
+        for key in ("load", "save", "upload", "abl_region"):
+            if metadata.get(key):
+                cmds.append(metadata[key])
+        for key in ("slot_save", "slot_load"):
+            cmds.extend(metadata.get(key, ()))
+        if "probe" in metadata:
+            cmds.extend(metadata["probe"][0])
+        if self.plugin._settings.get(["abl_custom"]):
+            cmds.extend(self.plugin._settings.get(["abl_gcode"]).split(","))
+        # plain moves could be part of the file
+        return {cmd.split()[0].upper() for cmd in cmds} - {"G0", "G1"}
+
+    def _track_temp(self, cmd):
+        temp = parse_temp(cmd)
+        if temp is not None:
+            self.temps[temp.heater] = temp.target
+
+    def _wait_hold(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.cond:
+                while self.on_hold and not self.queue:
+                    # a query timeout releases it from another thread
+                    if not self.cond.wait(deadline - time.monotonic()):
+                        raise TimeoutError("Job held and nothing to send")
+                if not self.queue:
+                    return
+            self._pump()
+
+    def _pump(self):
+        while True:
+            with self.cond:
+                if not self.queue:
+                    return
+                cmd = self.queue.popleft()
+            self._dispatch(cmd, API_TAGS)
+
+    def _dispatch(self, cmd, tags):
+        if cmd.startswith("@"):
+            words = cmd[1:].split(None, 1)
+            self._call(
+                "at_command",
+                None,
+                "sending",
+                words[0],
+                words[1] if len(words) > 1 else "",
+                tags=tags,
+            )
+            return
+        gcode = gcode_command_for_cmd(cmd)
+        self.sent.append((self.clock, cmd))
+        self._track_temp(cmd)
+        self._call(
+            "gcode_sent", None, "sent", cmd, None, gcode, tags=set(tags)
+        )
+        lines, elapsed = self.firmware.answer(cmd, self.clock)
+        self.clock += elapsed
+        for line in lines:
+            self._call("process_line", None, line)
+
+
+def load_settings(path, overrides):
+    settings = {}
+    if path is not None:
+        with open(path) as f:
+            if path.endswith((".yaml", ".yml")):
+                import yaml
+
+                data = yaml.safe_load(f) or {}
+            else:
+                data = json.load(f)
+        # OctoPrint config.yaml or the plugin settings alone
+        settings.update(data.get("plugins", {}).get("SmartABL", data))
+    for override in overrides:
+        key, _, value = override.partition("=")
+        try:
+            settings[key] = json.loads(value)
+        except ValueError:
+            settings[key] = value
+    return settings
+
+
+def clock(ts):
+    return datetime.fromtimestamp(ts).strftime("%H:%M:%S.%f")[:-3]
+
+
+def report(replay, top):
+    entries = replay.entries
+    sends = sum(1 for _, kind, _ in entries if kind == "send")
+    recvs = sum(1 for _, kind, _ in entries if kind == "recv")
+    plugin = replay.plugin
+    print(
+        f"{sends} sent, {recvs} received, {replay.prints} prints, "
+        f"firmware={plugin.firmware}, state={plugin.machine.state}"
+    )
+    print("decisions:")
+    for ts, outcome, reason in replay.decisions:
+        print(f"  {clock(ts)} {outcome:<12} {reason or ''}")
+    print("holds:")
+    for ts, recorded, wall in replay.holds:
+        print(
+            f"  {clock(ts)} printer={recorded * 1e3:8.1f}ms "
+            f"replay={wall * 1e3:6.2f}ms"
+        )
+    print("hooks:")
+    for hook, (count, elapsed) in sorted(replay.hooks.items()):
+        print(
+            f"  {hook:>14}: n={count:<6} total={elapsed * 1e3:8.2f}ms "
+            f"mean={elapsed / count * 1e9:8.0f}ns"
+        )
+    if replay.profiler is not None:
+        pstats.Stats(replay.profiler).sort_stats("cumulative").print_stats(top)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("log")
+    parser.add_argument(
+        "-s", "--settings", help="plugin settings (json or config.yaml)"
+    )
+    parser.add_argument("--state", help="state.json of the plugin")
+    parser.add_argument(
+        "-o",
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="override a setting",
+    )
+    parser.add_argument(
+        "-p", "--profile", type=int, metavar="N", help="cProfile top N"
+    )
+    parser.add_argument("-t", "--timeout", type=float, default=30)
+    args = parser.parse_args()
+
+    settings = load_settings(args.settings, args.set)
+    # debug logging would dominate the numbers
+    settings.setdefault("log_level", "WARNING")
+    replay = Replay(
+        parse(args.log), settings, args.state, profile=args.profile
+    )
+    try:
+        replay.run(args.timeout)
+    finally:
+        replay.close()
+    report(replay, args.profile)
+
+
+if __name__ == "__main__":
+    main()